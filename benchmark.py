@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+# Description:
+#  Generates synthetic Roland SP-404SX SD cards and times the parsing and conversion stages of ptn2midi and pysf
+#  on them at several scales, reporting throughput and peak memory and saving the results as JSON.
+
+# Usage:
+#  ./benchmark.py [--scales small,medium,large] [--repeat N] [--output FILE] [--compare FILE]
+#  ./benchmark.py --generate DIR [--patterns N] [--notes N] [--pads N] [--frames N] [--channels N] [--width N]
+#                [--format F]
+#  Where...
+#   --scales picks the scales to run, see SCALES
+#   --output is the JSON file the results are written to (default: benchmark.json)
+#   --compare prints how the results of this run compare to an earlier JSON file
+#   --generate only writes a synthetic card to DIR, for use with ptn2midi.py or cardindex.py
+
+import json
+import logging
+import os
+import os.path
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+import warnings
+from datetime import datetime
+
+import ptn2midi
+import pysf
+
+# scale name -> card parameters. notes and pads (distinct pads played) are per pattern, frames per sample
+SCALES = {
+    'small': dict(patterns=1, notes=64, pads=8, frames=4410, channels=2, width=2),
+    'medium': dict(patterns=4, notes=1024, pads=24, frames=44100, channels=2, width=2),
+    'large': dict(patterns=8, notes=8192, pads=48, frames=441000, channels=2, width=2),
+}
+DEFAULT_SCALES = 'small,medium'
+argument_description = "Times ptn2midi and pysf on synthetic SP-404SX cards."
+
+
+def write_pad_info(path, frames, channels):
+    records = []
+    for pad_number in range(1, ptn2midi.TOTAL_BANKS * ptn2midi.PADS_PER_BANK + 1):
+        end = 512 + 2 * frames
+        # user start and end trim a tenth of the sample off either side
+        records.append(struct.pack(ptn2midi.PAD_FORMAT, 512, end, 512 + 2 * (frames // 10),
+                                   end - 2 * (frames // 10), 127, False, False, False, False, 0, channels, 0, 1200,
+                                   1200))
+    with open(path + ptn2midi.PADINFO_PATH, 'wb') as f:
+        f.write(b''.join(records))
+
+
+# a pattern of note_count notes on pad_count pads picked from both bank halves, plus the closing empty note and
+# trailer. notes are shorter than the gap to the next step and a pad plays at most once per step, so no two
+# notes of a pad overlap.
+def write_pattern(path, pattern_name, note_count, pad_count, rng):
+    pad_numbers = rng.sample(range(1, ptn2midi.TOTAL_BANKS * ptn2midi.PADS_PER_BANK + 1), pad_count)
+    data = bytearray()
+    step_pads = set()
+    for note_index in range(note_count):
+        pad_number = rng.choice([pad_number for pad_number in pad_numbers if pad_number not in step_pads])
+        step_pads.add(pad_number)
+        # the delay of a note is the gap to the next one
+        delay = rng.choice((0, 12, 24, 48)) if len(step_pads) < pad_count else 12
+        if delay:
+            step_pads.clear()
+        second_half = pad_number > ptn2midi.PADS_PER_BANK * 5
+        pad = pad_number + 46 - second_half * ptn2midi.PADS_PER_BANK * 5
+        bank_switch = rng.choice((1, 65) if second_half else (0, 64))
+        data += struct.pack(ptn2midi.NOTE_FORMAT, delay, pad, bank_switch, 0, rng.randrange(1, 128), 0,
+                            rng.randrange(1, 12))
+    data += struct.pack(ptn2midi.NOTE_FORMAT, 96, ptn2midi.EMPTY_NOTE_PAD, 0, 0, 0, 0, 0)
+    data += bytes(9) + bytes([max(1, note_count // 64)]) + bytes(6)  # trailer, byte 9 is the number of bars
+    with open(path + ptn2midi.PATTERN_DIRECTORY + ptn2midi.pattern_name_to_filename(pattern_name), 'wb') as f:
+        f.write(data)
+
+
+def write_sample(file_path, frames, channels, width, sample_format, rng):
+    if sample_format == 'WAV':
+        open_sample = wave.open
+    else:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            import aifc  # gone from Python 3.13 on
+        open_sample = aifc.open
+    with open_sample(file_path, 'wb') as f:
+        f.setnchannels(channels)
+        f.setsampwidth(width)
+        f.setframerate(44100)
+        f.writeframes(rng.randbytes(frames * channels * width))
+
+
+# writes a synthetic card to path (with trailing slash) and returns the names of its patterns
+def generate_card(path, patterns=1, notes=64, pads=8, frames=4410, channels=2, width=2, sample_format='WAV',
+                  seed=404):
+    rng = random.Random(seed)
+    os.makedirs(path + ptn2midi.PATTERN_DIRECTORY, exist_ok=True)
+    os.makedirs(path + ptn2midi.SAMPLE_DIRECTORY, exist_ok=True)
+    write_pad_info(path, frames, channels)
+    pattern_names = []
+    for pattern_index in range(patterns):
+        pattern_name = chr(ord('A') + pattern_index // ptn2midi.PADS_PER_BANK) + str(
+            pattern_index % ptn2midi.PADS_PER_BANK + 1)
+        write_pattern(path, pattern_name, notes, pads, rng)
+        pattern_names.append(pattern_name)
+    for pad_number in range(1, ptn2midi.TOTAL_BANKS * ptn2midi.PADS_PER_BANK + 1):
+        write_sample(path + ptn2midi.SAMPLE_DIRECTORY + ptn2midi.pad_number_to_filename(pad_number, sample_format),
+                     frames, channels, width, sample_format, rng)
+    return pattern_names
+
+
+# runs stage once per repeat and returns the fastest wall time, then once more under tracemalloc for the peak
+def measure(stage, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stage()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    try:
+        stage()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def result(scale, stage, seconds, peak, notes=None, size=None):
+    entry = {'scale': scale, 'stage': stage, 'seconds': seconds, 'peak_memory_bytes': peak}
+    if notes is not None:
+        entry['notes'] = notes
+        entry['notes_per_second'] = notes / seconds if seconds else None
+    if size is not None:
+        entry['bytes'] = size
+        entry['megabytes_per_second'] = size / seconds / 1e6 if seconds else None
+    return entry
+
+
+def run_scale(scale, parameters, repeat, sample_format, work_dir):
+    card_path = os.path.join(work_dir, 'card') + '/'
+    pattern_names = generate_card(card_path, sample_format=sample_format, **parameters)
+    pattern_paths = [card_path + ptn2midi.PATTERN_DIRECTORY + ptn2midi.pattern_name_to_filename(name)
+                     for name in pattern_names]
+    pattern_bytes = sum(os.path.getsize(pattern_path) for pattern_path in pattern_paths)
+    note_count = len(pattern_names) * parameters['notes']
+    results = []
+
+    def run(stage, function, notes=None, size=None):
+        try:
+            seconds, peak = measure(function, repeat)
+        except (Exception, SystemExit) as error:
+            results.append({'scale': scale, 'stage': stage, 'error': repr(error)})
+            return
+        results.append(result(scale, stage, seconds, peak, notes, size))
+
+    run('get_pad_info', lambda: ptn2midi.get_pad_info(card_path), size=os.path.getsize(card_path +
+                                                                                        ptn2midi.PADINFO_PATH))
+    run('get_pattern', lambda: [ptn2midi.get_pattern(card_path, name) for name in pattern_names], note_count,
+        pattern_bytes)
+
+    pads = ptn2midi.get_pad_info(card_path)
+    patterns = [ptn2midi.get_pattern(card_path, name) for name in pattern_names]
+    midi_dir = os.path.join(work_dir, 'midi') + '/'
+    os.makedirs(midi_dir)
+    wave_tables = {}
+
+    def create_midi_files():
+        for name, notes in zip(pattern_names, patterns):
+            wave_tables[name] = ptn2midi.create_midi_file(pads, notes, 120, card_path, name, sample_format, midi_dir,
+                                                          midi_dir)
+
+    run('create_midi_file', create_midi_files, note_count)
+    if not wave_tables:
+        return results
+
+    # the SoundFont stages work on the wavetables of the first pattern
+    xml_path = os.path.join(work_dir, 'PTN.xml')
+    sf2_path = os.path.join(work_dir, 'PTN.sf2')
+    wave_table_list, path_list = wave_tables[pattern_names[0]]
+    ptn2midi.create_template(pattern_names[0], wave_table_list, path_list).XmlWrite(xml_path)
+    sample_bytes = sum(os.path.getsize(sample_path) for sample_path in path_list)
+    run('XmlToSf', lambda: pysf.XmlToSf(xml_path, sf2_path), size=sample_bytes)
+    if os.path.exists(sf2_path):
+        extract_dir = os.path.join(work_dir, 'extract')
+        os.makedirs(extract_dir)
+        run('SfToXml', lambda: pysf.SfToXml(sf2_path, os.path.join(extract_dir, 'PTN.xml')),
+            size=os.path.getsize(sf2_path))
+    return results
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(scales, repeat=3, sample_format='WAV'):
+    numpy = ptn2midi.load_numpy()
+    report = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': numpy.__version__ if numpy is not None else None,
+        'repeat': repeat,
+        'format': sample_format,
+        'scales': {scale: SCALES[scale] for scale in scales},
+        'results': [],
+    }
+    for scale in scales:
+        work_dir = tempfile.mkdtemp(prefix='ptn2midi_benchmark_' + scale + '_')
+        try:
+            report['results'] += run_scale(scale, SCALES[scale], repeat, sample_format, work_dir)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def format_rate(entry):
+    rates = []
+    if entry.get('notes_per_second') is not None:
+        rates.append('%.0f notes/s' % entry['notes_per_second'])
+    if entry.get('megabytes_per_second') is not None:
+        rates.append('%.1f MB/s' % entry['megabytes_per_second'])
+    return ', '.join(rates)
+
+
+def print_report(report, baseline=None):
+    previous = {}
+    if baseline is not None:
+        previous = {(entry['scale'], entry['stage']): entry for entry in baseline['results'] if 'seconds' in entry}
+    for entry in report['results']:
+        if 'error' in entry:
+            print('%-8s %-16s failed: %s' % (entry['scale'], entry['stage'], entry['error']))
+            continue
+        line = '%-8s %-16s %10.4f s %10.1f KiB peak  %s' % (entry['scale'], entry['stage'], entry['seconds'],
+                                                          entry['peak_memory_bytes'] / 1024.0, format_rate(entry))
+        old = previous.get((entry['scale'], entry['stage']))
+        if old is not None and entry['seconds']:
+            line += '  (%.2fx %s)' % (old['seconds'] / entry['seconds'], 'vs ' + (baseline['commit'] or '?')[:7])
+        print(line)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=argument_description)
+    parser.add_argument('--scales', default=DEFAULT_SCALES,
+                        help="Comma-separated scales to run, of " + ", ".join(SCALES) + " (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per stage, the fastest counts")
+    parser.add_argument('--output', default='benchmark.json', help="JSON file for the results")
+    parser.add_argument('--compare', help="JSON file of an earlier run to compare against")
+    parser.add_argument('--format', default='WAV', choices=['WAV', 'AIF'], help="Sample format of the cards")
+    parser.add_argument('--generate', metavar='DIR', help="Only write a synthetic card to DIR")
+    parser.add_argument('--patterns', type=int, default=1)
+    parser.add_argument('--notes', type=int, default=64, help="Notes per pattern")
+    parser.add_argument('--pads', type=int, default=8, help="Distinct pads played per pattern")
+    parser.add_argument('--frames', type=int, default=4410, help="Frames per sample")
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--width', type=int, default=2, help="Bytes per sample")
+    args = parser.parse_args(argv)
+    if args.generate is not None:
+        generate_card(ptn2midi.parsepath(args.generate), args.patterns, args.notes, args.pads, args.frames,
+                      args.channels, args.width, args.format)
+        return 0
+    scales = [scale for scale in args.scales.split(',') if scale]
+    for scale in scales:
+        if scale not in SCALES:
+            parser.error("unknown scale " + scale)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    logging.getLogger().setLevel(logging.ERROR)  # pysf warns about every wavetable without loop margin
+    report = run_benchmarks(scales, args.repeat, args.format)
+    print_report(report, baseline)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+# Description:
+#  Keeps an SQLite index of a Roland SP-404SX SD card on local disk: the patterns with the pads they play,
+#  the pad settings from PAD_INFO.BIN and the header and content hash of every sample.
+#  Rescans only open files whose size or modification time changed since the last scan.
+
+# Usage:
+#  ./cardindex.py SD_ROOT scan [--index FILE]
+#  ./cardindex.py SD_ROOT uses PAD_NAME [--index FILE]
+#  ./cardindex.py SD_ROOT changes [--index FILE]
+#  Where...
+#   SD_ROOT is the path (with trailing slash) to the top-level of the Roland SD card e.g. '/media/tz/SP-404SX/'
+#   PAD_NAME is the name of a pad e.g. 'b7'
+#  uses and changes only read the index; run scan first to bring it up to date with the card.
+
+import hashlib
+import os
+import os.path
+import sqlite3
+import warnings
+import wave
+from datetime import datetime
+
+import ptn2midi
+
+INDEX_DIRECTORY = os.path.join(ptn2midi.SAMPLE_CACHE_DIRECTORY, 'index')
+INDEX_SCHEMA_VERSION = 1
+INDEX_SCHEMA = '''
+create table if not exists scans (id integer primary key, time text not null);
+create table if not exists files (path text primary key, kind text not null, size integer not null,
+                                  mtime_ns integer not null, sha1 text not null, scan_id integer not null);
+create table if not exists changes (scan_id integer not null, path text not null, change text not null);
+create table if not exists patterns (name text primary key, path text not null, note_count integer not null,
+                                     end_tick integer not null);
+create table if not exists pattern_pads (pattern text not null, pad integer not null, note_count integer not null,
+                                         primary key (pattern, pad));
+create index if not exists pattern_pads_by_pad on pattern_pads (pad);
+create table if not exists pads (pad integer primary key, name text not null, %s);
+create table if not exists samples (path text primary key, pad integer not null, channels integer,
+                                    sampwidth integer, framerate integer, frames integer);
+''' % ", ".join('%s integer not null' % field for field in ptn2midi.PAD_FIELDS)
+sd_root_help = ptn2midi.sd_root_help
+argument_description = "Keeps an SQLite index of a Roland SP-404SX SD card and answers questions from it."
+
+
+# pad number (eg 19) to pad name (eg "B7")
+def pad_number_to_name(pad_number):
+    pad_number -= 1
+    return chr(ord('A') + pad_number // ptn2midi.PADS_PER_BANK) + str(pad_number % ptn2midi.PADS_PER_BANK + 1)
+
+
+# pad name (eg "B7") to pad number (eg 19)
+def pad_name_to_number(pad_name):
+    return (ord(pad_name[0].upper()) - ord('A')) * ptn2midi.PADS_PER_BANK + int(pad_name[1:])
+
+
+assert (pad_number_to_name(19) == 'B7')
+assert (pad_name_to_number('b7') == 19)
+assert (pad_name_to_number(pad_number_to_name(120)) == 120)
+
+
+# pad number of a sample file name (eg "B0000007.WAV"), None for other files
+def sample_filename_to_pad_number(filename):
+    name, extension = os.path.splitext(filename.upper())
+    if len(name) != 8 or not 'A' <= name[0] <= 'J' or not name[1:].isdigit() or extension not in ('.WAV', '.AIF'):
+        return None
+    if not 1 <= int(name[1:]) <= ptn2midi.PADS_PER_BANK:
+        return None
+    return (ord(name[0]) - ord('A')) * ptn2midi.PADS_PER_BANK + int(name[1:])
+
+
+def file_hash(path):
+    content_hash = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+# channels, sampwidth, framerate and frames of a sample, all None when the header can not be read
+def sample_header(path):
+    if path.upper().endswith('.WAV'):
+        opener, errors = wave.open, (wave.Error,)
+    else:
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', DeprecationWarning)
+                import aifc  # gone from Python 3.13 on
+        except ImportError:
+            return None, None, None, None
+        opener, errors = aifc.open, (aifc.Error,)
+    try:
+        with opener(path, 'rb') as f:
+            return f.getnchannels(), f.getsampwidth(), f.getframerate(), f.getnframes()
+    except (EOFError, OSError) + errors:
+        return None, None, None, None
+
+
+def index_path_for_card(path):
+    card_key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(INDEX_DIRECTORY, card_key + '.sqlite')
+
+
+class CardIndex:
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or index_path_for_card(path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        self.db = sqlite3.connect(self.index_path)
+        if self.db.execute('pragma user_version').fetchone()[0] != INDEX_SCHEMA_VERSION:
+            self.db.executescript(''.join('drop table if exists %s;' % table for table in
+                                          ('scans', 'files', 'changes', 'patterns', 'pattern_pads', 'pads',
+                                           'samples')))
+            self.db.executescript(INDEX_SCHEMA)
+            self.db.execute('pragma user_version = %d' % INDEX_SCHEMA_VERSION)
+            self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    # files of the card the index cares about: (relative path, kind, stat) from one directory listing each
+    def card_files(self):
+        for directory, kind in ((ptn2midi.PATTERN_DIRECTORY, 'pattern'), (ptn2midi.SAMPLE_DIRECTORY, 'sample')):
+            try:
+                entries = list(os.scandir(self.path + directory))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                filename = entry.name.upper()
+                if kind == 'pattern' and not (filename.startswith('PTN') and filename.endswith('.BIN')):
+                    continue
+                if kind == 'sample' and directory + entry.name == ptn2midi.PADINFO_PATH:
+                    yield directory + entry.name, 'padinfo', entry.stat()
+                    continue
+                if kind == 'sample' and sample_filename_to_pad_number(filename) is None:
+                    continue
+                yield directory + entry.name, kind, entry.stat()
+
+    # brings the index up to date with the card and returns the (path, change) list of this scan
+    def scan(self):
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in
+                 self.db.execute('select path, size, mtime_ns from files')}
+        scan_id = self.db.execute('insert into scans (time) values (?)',
+                                  (datetime.now().isoformat(timespec='seconds'),)).lastrowid
+        changes = []
+        for path, kind, stat in self.card_files():
+            identity = known.pop(path, None)
+            if identity == (stat.st_size, stat.st_mtime_ns):
+                continue
+            changes.append((path, 'added' if identity is None else 'modified'))
+            self.db.execute('insert or replace into files values (?, ?, ?, ?, ?, ?)',
+                            (path, kind, stat.st_size, stat.st_mtime_ns, file_hash(self.path + path), scan_id))
+            getattr(self, 'index_' + kind)(path)
+        for path in known:
+            changes.append((path, 'removed'))
+            self.forget(path)
+        changes.sort()
+        self.db.executemany('insert into changes values (?, ?, ?)', [(scan_id, path, change)
+                                                                     for path, change in changes])
+        self.db.commit()
+        return changes
+
+    def forget(self, path):
+        self.db.execute('delete from files where path = ?', (path,))
+        self.db.execute('delete from samples where path = ?', (path,))
+        self.forget_pattern(path)
+        if path == ptn2midi.PADINFO_PATH:
+            self.db.execute('delete from pads')
+
+    def index_pattern(self, path):
+        self.forget_pattern(path)
+        name = ptn2midi.filename_to_pattern_name(os.path.basename(path).upper())
+        with open(self.path + path, 'rb') as f:
+            pattern = ptn2midi.Pattern(f.read())
+        pad_counts = {}
+        for sample_number in pattern.sample_numbers():
+            if sample_number:
+                pad_counts[int(sample_number)] = pad_counts.get(int(sample_number), 0) + 1
+        self.db.execute('insert into patterns values (?, ?, ?, ?)', (name, path, len(pattern), pattern.end_tick))
+        self.db.executemany('insert into pattern_pads values (?, ?, ?)',
+                            [(name, pad, count) for pad, count in sorted(pad_counts.items())])
+
+    def forget_pattern(self, path):
+        for (name,) in self.db.execute('select name from patterns where path = ?', (path,)).fetchall():
+            self.db.execute('delete from pattern_pads where pattern = ?', (name,))
+        self.db.execute('delete from patterns where path = ?', (path,))
+
+    def index_padinfo(self, path):
+        pads = ptn2midi.get_pad_info(self.path)
+        self.db.execute('delete from pads')
+        self.db.executemany('insert into pads values (%s)' % ", ".join('?' * (len(ptn2midi.PAD_FIELDS) + 2)),
+                            [(pad_number, pad_number_to_name(pad_number)) + tuple(pad)
+                             for pad_number, pad in pads.items()])
+
+    def index_sample(self, path):
+        self.db.execute('insert or replace into samples values (?, ?, ?, ?, ?, ?)',
+                        (path, sample_filename_to_pad_number(os.path.basename(path))) +
+                        sample_header(self.path + path))
+
+    # names of the patterns that play a pad, in card order
+    def patterns_using(self, pad_number):
+        return [name for (name,) in self.db.execute('select pattern from pattern_pads join patterns on name = pattern'
+                                                    ' where pad = ? order by path', (pad_number,))]
+
+    # (path, change) list of the scans after since_scan_id, by default of the most recent scan only
+    def changes(self, since_scan_id=None):
+        if since_scan_id is None:
+            since_scan_id = self.db.execute('select coalesce(max(id), 1) - 1 from scans').fetchone()[0]
+        return self.db.execute('select path, change from changes where scan_id > ? order by scan_id, path',
+                               (since_scan_id,)).fetchall()
+
+    def pad(self, pad_number):
+        row = self.db.execute('select * from pads where pad = ?', (pad_number,)).fetchone()
+        if row is None:
+            return None
+        return ptn2midi.Pad._make(bool(value) if code == '?' else value
+                                  for value, code in zip(row[2:], ptn2midi.PAD_FORMAT[1:]))
+
+    # (path, channels, sampwidth, framerate, frames) of the samples of a pad
+    def samples(self, pad_number):
+        return self.db.execute('select path, channels, sampwidth, framerate, frames from samples where pad = ?'
+                               ' order by path', (pad_number,)).fetchall()
+
+    # content hash of a card file as of the last scan
+    def file_hash(self, path):
+        row = self.db.execute('select sha1 from files where path = ?', (path,)).fetchone()
+        return None if row is None else row[0]
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description=argument_description)
+    parser.add_argument("SD_ROOT", help=sd_root_help)
+    parser.add_argument("COMMAND", choices=['scan', 'uses', 'changes'])
+    parser.add_argument("PAD_NAME", nargs='?', help="The name of the pad for 'uses' e.g. 'b7'")
+    parser.add_argument("--index", help="Index file to use instead of one in the cache directory")
+    args = parser.parse_args(argv)
+    with CardIndex(ptn2midi.parsepath(args.SD_ROOT), args.index) as index:
+        if args.COMMAND == 'scan':
+            for changed_path, change in index.scan():
+                print(change + " " + changed_path)
+        elif args.COMMAND == 'uses':
+            if args.PAD_NAME is None:
+                parser.error("uses needs a PAD_NAME")
+            for pattern_name in index.patterns_using(pad_name_to_number(args.PAD_NAME)):
+                print(pattern_name)
+        else:
+            for changed_path, change in index.changes():
+                print(change + " " + changed_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# Description:
+#  Per-stage wall time, call count and byte counters for ptn2midi and pysf.
+#  Functions decorated with stage() are timed while instrumentation is enabled; bytes_read() and bytes_written()
+#  add to the innermost stage running on the calling thread. While disabled a stage costs one flag test.
+
+# Library use:
+#  instrumentation.enable()
+#  ptn2midi.convert_pattern(...)
+#  print(instrumentation.report())
+#  or instrumentation.add_hook(hook) to be called at the end of every stage.
+
+import functools
+import threading
+import time
+
+enabled = False
+active = False  # enabled or any hooks
+hooks = []
+stats = {}  # stage name -> [calls, seconds, bytes read, bytes written]
+stats_lock = threading.Lock()
+running = threading.local()  # .frames: [bytes read, bytes written] of the stages running on this thread
+
+
+def enable():
+    global enabled
+    enabled = True
+    update_active()
+
+
+def disable():
+    global enabled
+    enabled = False
+    update_active()
+
+
+def update_active():
+    global active
+    active = enabled or bool(hooks)
+
+
+def reset():
+    with stats_lock:
+        stats.clear()
+
+
+# hook(name, seconds, bytes_read, bytes_written) is called at the end of every stage, even while disabled
+def add_hook(hook):
+    hooks.append(hook)
+    update_active()
+
+
+def remove_hook(hook):
+    hooks.remove(hook)
+    update_active()
+
+
+# decorator timing every call of a function as the stage name
+def stage(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            if not active:
+                return function(*args, **kwargs)
+            frames = getattr(running, 'frames', None)
+            if frames is None:
+                frames = running.frames = []
+            frame = [0, 0]
+            frames.append(frame)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                frames.pop()
+                record(name, 1, seconds, frame[0], frame[1])
+                for hook in list(hooks):
+                    hook(name, seconds, frame[0], frame[1])
+        return timed
+    return decorate
+
+
+def bytes_read(count):
+    if active and getattr(running, 'frames', None):
+        running.frames[-1][0] += count
+
+
+def bytes_written(count):
+    if active and getattr(running, 'frames', None):
+        running.frames[-1][1] += count
+
+
+def record(name, calls, seconds, read, written):
+    with stats_lock:
+        entry = stats.setdefault(name, [0, 0.0, 0, 0])
+        entry[0] += calls
+        entry[1] += seconds
+        entry[2] += read
+        entry[3] += written
+
+
+# the counters so far as a JSON-friendly dict of stage name -> calls, seconds, bytes_read and bytes_written
+def report():
+    with stats_lock:
+        return {'stages': {name: {'calls': calls, 'seconds': seconds, 'bytes_read': read, 'bytes_written': written}
+                           for name, (calls, seconds, read, written) in sorted(stats.items())}}
+
+
+# adds a report, e.g. one taken in a worker process, to the counters of this process
+def merge(other):
+    for name, entry in other['stages'].items():
+        record(name, entry['calls'], entry['seconds'], entry['bytes_read'], entry['bytes_written'])
+
+
+# report() and reset() in one step
+def take():
+    taken = report()
+    reset()
+    return taken
+
+
+def write_report(path, extra=None):
+    import json
+
+    data = report()
+    data.update(extra or {})
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.write('\n')
@@ -4,47 +4,53 @@
 #  Parses a pattern from a Roland SP-404SX SD card and creates a MIDI file and SoundFont file.
 
 # Usage:
-#  ./ptn2midi.py SD_ROOT PATTERN_NAME TEMPO
+#  ./ptn2midi.py SD_ROOT PATTERN_NAME TEMPO SAMPLE_FORMAT [--jobs N] [--output-dir DIR] [--merge NAME] [--render]
+#                [--stream FILE] [--profile FILE]
 #  Where...
 #   SD_ROOT is the path (with trailing slash) to the top-level of the Roland SD card e.g. '/media/tz/SP-404SX/'
-#   PATTERN_NAME is the name of the pattern e.g. 'a1'
+#   PATTERN_NAME is the name of the pattern e.g. 'a1', a comma-separated list e.g. 'a1,a2,b12',
+#    or 'all' for every pattern on the card
 
 # Output:
 #  PTN_F1.mid
 #  PTN_F1.sf2
-
-import argparse
-import importlib
+#  In batch mode (more than one pattern) each pattern is written to its own OUTPUT_DIR/PTN_<name>/ directory.
+#  With --merge NAME all the patterns go to OUTPUT_DIR/NAME.mid and OUTPUT_DIR/NAME.sf2 instead, one track and one
+#  preset per pattern, every pad sample stored once.
+#  With --render each pattern is mixed down to OUTPUT_DIR/PTN_<name>.wav instead, no MIDI or SoundFont needed.
+#  With --stream FILE the patterns are mixed one after the other into a single WAV written to FILE block by block
+#  as it is rendered; FILE can be a named pipe, or '-' for standard output.
+
+# Library use:
+#  pads = ptn2midi.get_pad_info(SD_ROOT)                      parse PAD_INFO.BIN into a PadTable
+#  notes = ptn2midi.get_pattern(SD_ROOT, 'a1')                parse a pattern into a Pattern
+#  ptn2midi.convert_pattern(pads, SD_ROOT, 'a1', 95, 'WAV')   build PTN_A1.mid and PTN_A1.sf2
+#  ptn2midi.convert_merged(SD_ROOT, ['a1', 'a2'], 95, 'WAV', 'CARD')   build CARD.mid and CARD.sf2
+#  ptn2midi.render_pattern(pads, SD_ROOT, 'a1', 95, 'WAV')    mix PTN_A1.wav
+#  ptn2midi.render_chain(pads, SD_ROOT, ['a1', 'a2'], 95, 'WAV', out)   stream the mix to a file, pipe or socket
+#  or ptn2midi.render_blocks(...) for the mixed PCM blocks themselves.
+#  or step by step with create_midi_file, create_template and create_soundfont_file.
+#  midiutil, numpy and pysf are only imported by the first call that needs them.
+
+import array
+import hashlib
+import instrumentation
+import itertools
 import os
 import os.path
-import pysf
 import shutil
 import struct
 import sys
+import tempfile
+import threading
+import time
 import wave
-import xml.etree.ElementTree as ElementTree
-from collections import namedtuple
+from collections import deque, namedtuple
 from datetime import datetime
 
-from midiutil.MidiFile import MIDIFile
-from pydub import AudioSegment
-
-freepatstools = importlib.import_module("freepats-tools")
-date = datetime.today().strftime('%Y-%m-%d')
+numpy = False  # optional, imported by load_numpy on first use
 sd_root_help = "The path (with trailing slash) to the top-level of the Roland SD card e.g. '/media/tz/SP-404SX/'"
 argument_description = "Parses a pattern from a Roland SP-404SX SD card and creates a MIDI file and SoundFont file."
-parser = argparse.ArgumentParser(
-    description=argument_description)
-parser.add_argument('SD_ROOT',
-                    help=sd_root_help)
-parser.add_argument('PATTERN_NAME', help="The name of the pattern e.g. 'a1'")
-parser.add_argument('TEMPO', help="The tempo in beats per minute e.g. '95'")
-parser.add_argument('SAMPLE_FORMAT', help="Sample format - WAV or AIFF")
-if len(sys.argv) < 4:
-    parser.print_help()
-    sys.exit(1)
-args = parser.parse_args()
-
 TOTAL_BANKS = 10
 PADS_PER_BANK = 12
 PPQ = 96  # ubuntu saucy's python-midiutil 0.87-3 has TICKS_PER_BEAT==128
@@ -53,6 +59,53 @@ PADINFO_PATH = 'ROLAND/SP-404SX/SMPL/PAD_INFO.BIN'
 PATTERN_DIRECTORY = 'ROLAND/SP-404SX/PTN/'
 SAMPLE_DIRECTORY = 'ROLAND/SP-404SX/SMPL/'
 BYTES_PER_NOTE = 8
+SAMPLE_CACHE_DIRECTORY = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                      'sp404sx_librarian')
+SAMPLE_CACHE_SIZE_LIMIT = 1024 * 1024 * 1024
+SAMPLE_CACHE_FORMAT = 'trimmed mono WAV v1'  # bump whenever the prepared sample data changes
+PAD_FIELDS = ['start',
+              'end',
+              'user_start',
+              'user_end',
+              'volume',
+              'lofi',
+              'loop',
+              'gate',
+              'reverse',
+              'unknown1',
+              'channels',
+              'tempo_mode',
+              'tempo',
+              'user_tempo']
+# defined at module level so that pads and notes can be handed to worker processes
+Pad = namedtuple('Pad', " ".join(PAD_FIELDS))
+Note = namedtuple('Note', 'delay pad bank_switch unknown2 velocity unknown3 length')
+NOTE_FORMAT = '>BBBBBBH'
+PAD_FORMAT = '>IIIIB????BBBII'
+PAD_DTYPE = [('start', '>u4'), ('end', '>u4'), ('user_start', '>u4'), ('user_end', '>u4'), ('volume', 'u1'),
+             ('lofi', '?'), ('loop', '?'), ('gate', '?'), ('reverse', '?'), ('unknown1', 'u1'), ('channels', 'u1'),
+             ('tempo_mode', 'u1'), ('tempo', '>u4'), ('user_tempo', '>u4')]
+EMPTY_NOTE_PAD = 128
+RENDER_FRAME_RATE = 44100
+RENDER_SAMPLE_WIDTH = 2
+RENDER_BLOCK_FRAMES = 4096  # about 93 ms at RENDER_FRAME_RATE
+
+
+# numpy if it is installed, None otherwise. importing it takes longer than everything else ptn2midi
+# needs to convert a small pattern, so it is only imported by the first code path that can use it.
+def load_numpy():
+    global numpy
+    if numpy is False:
+        try:
+            import numpy as numpy_module
+        except ImportError:
+            numpy_module = None
+        numpy = numpy_module
+    return numpy
+
+
+def today():
+    return datetime.today().strftime('%Y-%m-%d')
 
 
 # pad number (eg 13) to file name (eg "B0000001.WAV")
@@ -68,65 +121,163 @@ assert (pad_number_to_filename(1, 'WAV') == 'A0000001.WAV')
 assert (pad_number_to_filename(120, 'WAV') == 'J0000012.WAV')
 
 
-# pattern name (eg B12) to pattern file name (eg PTN00012.BIN)
+# pattern name (eg B12) to pattern file name (eg PTN00024.BIN)
 def pattern_name_to_filename(pattern_name):
-    x = (ord(pattern_name[0].upper()) - ord('A')) * 12
-    y = int(pattern_name[1:]) % PADS_PER_BANK
+    x = (ord(pattern_name[0].upper()) - ord('A')) * PADS_PER_BANK
+    y = (int(pattern_name[1:]) - 1) % PADS_PER_BANK + 1
     return 'PTN' + str(x + y).zfill(5) + '.BIN'
 
 
 assert (pattern_name_to_filename("A1") == 'PTN00001.BIN')
+assert (pattern_name_to_filename("A12") == 'PTN00012.BIN')
 assert (pattern_name_to_filename("B11") == 'PTN00023.BIN')
 
 
+# pattern file name (eg PTN00024.BIN) to pattern name (eg B12)
+def filename_to_pattern_name(filename):
+    pattern_number = int(filename[3:8]) - 1
+    bank_name = chr(ord('A') + int(pattern_number / PADS_PER_BANK))
+    return bank_name + str((pattern_number % PADS_PER_BANK) + 1)
+
+
+assert (filename_to_pattern_name('PTN00001.BIN') == 'A1')
+assert (filename_to_pattern_name('PTN00024.BIN') == 'B12')
+
+
+# names of all patterns stored on the card, in card order
+def list_patterns(path):
+    pattern_names = []
+    for filename in sorted(os.listdir(path + PATTERN_DIRECTORY)):
+        if filename.upper().startswith('PTN') and filename.upper().endswith('.BIN'):
+            pattern_names.append(filename_to_pattern_name(filename.upper()))
+    return pattern_names
+
+
 # parse settings of each pad
+@instrumentation.stage('ptn2midi.get_pad_info')
 def get_pad_info(path):
     # http://sp-forums.com/viewtopic.php?p=60548&sid=840a92a45a7790dd9b593f061ffb4478#p60548
     # http://sp-forums.com/viewtopic.php?p=60553#p60553
-    pad_list = ['start',
-                'end',
-                'user_start',
-                'user_end',
-                'volume',
-                'lofi',
-                'loop',
-                'gate',
-                'reverse',
-                'unknown1',
-                'channels',
-                'tempo_mode',
-                'tempo',
-                'user_tempo']
-    Pad = namedtuple('Pad', " ".join(pad_list))
-    f = open(path + PADINFO_PATH, 'rb')
-    pads = {}
-    i = 0
-    while i < TOTAL_BANKS * PADS_PER_BANK:
-        pad_data = f.read(32)
-        pad = Pad._make(struct.unpack('>IIIIB????BBBII', pad_data))
-        pads[i + 1] = pad
-        i += 1
-    return pads
+    with open(path + PADINFO_PATH, 'rb') as f:
+        data = f.read(struct.calcsize(PAD_FORMAT) * TOTAL_BANKS * PADS_PER_BANK)
+    instrumentation.bytes_read(len(data))
+    return PadTable(data)
+
+
+# the settings of all 120 pads decoded in one go into columns (numpy arrays when numpy is installed,
+# array.array otherwise), one entry per pad, plus the trim_start/trim_end frame range of every pad.
+# indexing by pad number (1-120) gives a Pad tuple like the dict get_pad_info used to return.
+# pickles as the raw 3840 bytes of PAD_INFO.BIN.
+class PadTable:
+    def __init__(self, data):
+        self.data = bytes(data)
+        pad_count = TOTAL_BANKS * PADS_PER_BANK
+        if load_numpy() is not None:
+            pads = numpy.frombuffer(self.data, numpy.dtype(PAD_DTYPE), pad_count)
+            for field in PAD_FIELDS:
+                setattr(self, field, pads[field])
+            self.trim_start = (self.user_start.astype(numpy.int64) - 512) // 2
+            self.trim_end = (self.user_end.astype(numpy.int64) - 512) // 2
+        else:
+            if len(self.data) < struct.calcsize(PAD_FORMAT) * pad_count:
+                raise ValueError("PAD_INFO.BIN is too short")
+            columns = zip(*struct.iter_unpack(PAD_FORMAT, self.data[:struct.calcsize(PAD_FORMAT) * pad_count]))
+            for field, code, column in zip(PAD_FIELDS, PAD_FORMAT[1:], columns):
+                setattr(self, field, array.array('I' if code == 'I' else 'B', column))
+            self.trim_start = array.array('q', [(user_start - 512) // 2 for user_start in self.user_start])
+            self.trim_end = array.array('q', [(user_end - 512) // 2 for user_end in self.user_end])
+
+    def __reduce__(self):
+        return PadTable, (self.data,)
+
+    def __len__(self):
+        return len(self.start)
+
+    def __iter__(self):
+        return iter(range(1, len(self) + 1))
+
+    def __contains__(self, pad_number):
+        return 1 <= pad_number <= len(self)
+
+    def __getitem__(self, pad_number):
+        if pad_number not in self:
+            raise KeyError(pad_number)
+        return Pad._make(bool(getattr(self, field)[pad_number - 1]) if code == '?' else
+                         int(getattr(self, field)[pad_number - 1]) for field, code in zip(PAD_FIELDS, PAD_FORMAT[1:]))
+
+    def items(self):
+        for pad_number in self:
+            yield pad_number, self[pad_number]
+
+    # frames of the pad's sample between its user start and end points
+    def trim_range(self, pad_number):
+        return int(self.trim_start[pad_number - 1]), int(self.trim_end[pad_number - 1])
 
 
 # parse pattern
+@instrumentation.stage('ptn2midi.get_pattern')
 def get_pattern(path, pattern):
     # http://sp-forums.com/viewtopic.php?p=60635&sid=820f29eed0f7275dbeaf776173911736#p60635
     # http://sp-forums.com/viewtopic.php?p=60693&sid=820f29eed0f7275dbeaf776173911736#p60693
-    Note = namedtuple('Note', 'delay pad bank_switch unknown2 velocity unknown3 length')
-    f = open(path + PATTERN_DIRECTORY + pattern_name_to_filename(pattern), 'rb')
-    ptn_filesize = os.fstat(f.fileno()).st_size
-    notes = []
-    i = 0
-    while i < (ptn_filesize / BYTES_PER_NOTE) - 2:  # 2*8 trailer bytes at the end of the file
-        note_data = f.read(8)
-        note = Note._make(struct.unpack('>BBBBBBH', note_data))
-        notes.append(note)
-
-        i += 1
-    #ptn_trailer = f.read(16) - not currently used
-    #ptn_bars = ptn_trailer[9] - not currently used
-    return notes
+    with open(path + PATTERN_DIRECTORY + pattern_name_to_filename(pattern), 'rb') as f:
+        data = f.read()
+    instrumentation.bytes_read(len(data))
+    return Pattern(data)
+
+
+# the notes of a pattern file decoded in one go into columns, one entry per note:
+# delay, pad, bank_switch, unknown2, velocity, unknown3 and length as in Note, plus tick, the absolute
+# position of the note in PPQ ticks. columns are numpy arrays when numpy is installed (and notes is then the
+# underlying structured array), array.array otherwise. iterating a Pattern still yields Note tuples.
+class Pattern:
+    def __init__(self, data):
+        note_count = max(len(data) // BYTES_PER_NOTE - 2, 0)  # 2*8 trailer bytes at the end of the file
+        body = data[:note_count * BYTES_PER_NOTE]
+        self.trailer = data[note_count * BYTES_PER_NOTE:]
+        # ptn_bars = self.trailer[9] - not currently used
+        if load_numpy() is not None:
+            self.notes = numpy.frombuffer(body, numpy.dtype([(field, 'u1') for field in Note._fields[:-1]] +
+                                                            [('length', '>u2')]))
+            for field in Note._fields:
+                setattr(self, field, self.notes[field])
+            ticks = numpy.cumsum(self.delay, dtype=numpy.int64)
+            self.end_tick = int(ticks[-1]) if note_count else 0
+            self.tick = ticks - self.delay
+        else:
+            self.notes = None
+            for offset, field in enumerate(Note._fields[:-1]):
+                setattr(self, field, array.array('B', body[offset::BYTES_PER_NOTE]))
+            length = bytearray(note_count * 2)
+            length[0::2] = body[6::BYTES_PER_NOTE]
+            length[1::2] = body[7::BYTES_PER_NOTE]
+            self.length = array.array('H', length)
+            if sys.byteorder == 'little':
+                self.length.byteswap()
+            ticks = array.array('q', itertools.accumulate(self.delay, initial=0))
+            self.end_tick = ticks.pop()
+            self.tick = ticks
+
+    def __len__(self):
+        return len(self.delay)
+
+    def __getitem__(self, index):
+        return Note._make(int(getattr(self, field)[index]) for field in Note._fields)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    # pad number (1-120) of every note, 0 for empty notes
+    def sample_numbers(self):
+        if self.notes is not None:
+            bank_switch = self.bank_switch.astype(numpy.int64)
+            empty = self.pad == EMPTY_NOTE_PAD
+            if not numpy.isin(bank_switch[~empty], (0, 1, 64, 65)).all():
+                raise ValueError("unexpected value for bank_switch")
+            second_half = (bank_switch == 1) | (bank_switch == 65)
+            return numpy.where(empty, 0, self.pad.astype(numpy.int64) - 46 + second_half * PADS_PER_BANK * 5)
+        return array.array('q', [0 if note.pad == EMPTY_NOTE_PAD else notetuple_to_sample_number(note)
+                                 for note in self])
 
 
 def notetuple_to_note_filename(note, sampleformat):
@@ -139,179 +290,718 @@ def notetuple_to_sample_number(note):
     elif note.bank_switch == 65 or note.bank_switch == 1:
         sample_number = note.pad - 46 + PADS_PER_BANK * 5
     else:
-        print("unexpected value for bank_switch")
-        sys.exit(1)
+        raise ValueError("unexpected value for bank_switch")
 
     return sample_number
 
 
-def padtuple_to_trim_samplenums(pad):
-    return (pad.user_start - 512) / 2, (pad.user_end - 512) / 2
+@instrumentation.stage('ptn2midi.create_midi_file')
+def create_midi_file(pads, notes, midi_tempo, path, pattern, sampleformat, work_dir="/tmp/", output_dir="",
+                     sample_cache=None):
+    import concurrent.futures
+    from midiutil.MidiFile import MIDIFile
 
-
-def create_midi_file(pads, notes, midi_tempo, path, pattern, sampleformat):
     midi_file = MIDIFile(numTracks=1)
-    midi_file.addTrackName(track=0, time=0, trackName="Roland SP404SX Pattern " + pattern.upper() + " " + date)
+    midi_file.addTrackName(track=0, time=0, trackName="Roland SP404SX Pattern " + pattern.upper() + " " + today())
     midi_file.addTempo(track=0, time=0, tempo=midi_tempo)
-    note_path_to_pitch = {}
+    sample_numbers = notes.sample_numbers()
+    # distinct samples in order of first use, each is prepared and becomes a wavetable exactly once
+    sample_number_to_path = {}
+    for sample_number in sample_numbers:
+        if sample_number and sample_number not in sample_number_to_path:
+            sample_number_to_path[sample_number] = path + SAMPLE_DIRECTORY + pad_number_to_filename(
+                int(sample_number), sampleformat)
+    sample_number_to_pitch = {}
     # for C1. see "midi note numbers" in http://www.sengpielaudio.com/calculator-notenames.htm
     next_available_pitch = 36
     wave_table_list = []
     path_list = []
-    time_in_beats_for_next_note = 0
-    for note in notes:
-        if note.pad != 128:
-            note_filename = notetuple_to_note_filename(note, sampleformat)
-            note_path = path + SAMPLE_DIRECTORY + note_filename
-            wave_table_list.append(note_filename)
+    for sample_number, note_path in sample_number_to_path.items():
+        if os.path.isfile(note_path):
+            sample_number_to_pitch[sample_number] = next_available_pitch
+            next_available_pitch += 1
+            wave_table_list.append(os.path.basename(note_path))
             path_list.append(note_path)
-            if note_path not in note_path_to_pitch:
-                note_path_to_pitch[note_path] = next_available_pitch
-                next_available_pitch += 1
-            if os.path.isfile(note_path):
-                pad = pads[notetuple_to_sample_number(note)]
-                user_start_sample, user_end_sample = padtuple_to_trim_samplenums(pad)
-                outfile_path = "/tmp/" + os.path.basename(note_path)
-                trim_wav_by_frame_numbers(note_path, outfile_path, user_start_sample, user_end_sample)
-                stereo_to_mono(outfile_path, outfile_path + "_mono.wav")
-                length = note.length / (PPQ * 1.0)
-                midi_file.addNote(track=0, channel=0, pitch=note_path_to_pitch[note_path],
-                                  time=time_in_beats_for_next_note, duration=length, volume=100)
-            else:
-                print("skipping missing sample")
-        else:
-            print("skipping empty note")
-        delay = note.delay / (PPQ * 1.0)
-        print("incrementing time by", delay)
-        time_in_beats_for_next_note += delay
-
-    # j = 36
-    # while True:
-
-    for i in note_path_to_pitch:
-        template_wav_path = "template" + ('%02d' % (note_path_to_pitch[i] - 35)) + ".wav"
-        trimmed_mono_path = "/tmp/" + os.path.basename(i) + "_mono.wav"
-        if os.path.isfile(i):
-            shutil.copyfile(trimmed_mono_path, template_wav_path)
         else:
-            print("skipping missing sample wav")
+            print("skipping missing sample", note_path)
+
+    def prepare_note_sample(sample_number):
+        user_start_sample, user_end_sample = pads.trim_range(sample_number)
+        return prepare_sample(sample_number_to_path[sample_number], user_start_sample, user_end_sample, work_dir,
+                              sample_cache)
+
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        trimmed_mono_paths = list(executor.map(prepare_note_sample, sample_number_to_pitch))
 
-    binfile = open("PTN_" + pattern.upper() + ".mid", 'wb')
+    for sample_number, tick, length in zip(sample_numbers, notes.tick, notes.length):
+        if sample_number in sample_number_to_pitch:
+            midi_file.addNote(track=0, channel=0, pitch=sample_number_to_pitch[sample_number],
+                              time=tick / (PPQ * 1.0), duration=length / (PPQ * 1.0), volume=100)
+
+    for pitch, trimmed_mono_path in zip(sample_number_to_pitch.values(), trimmed_mono_paths):
+        template_wav_path = output_dir + "template" + ('%02d' % (pitch - 35)) + ".wav"
+        shutil.copyfile(trimmed_mono_path, template_wav_path)
+
+    binfile = open(output_dir + "PTN_" + pattern.upper() + ".mid", 'wb')
     midi_file.writeFile(binfile)
+    instrumentation.bytes_written(binfile.tell())
     binfile.close()
     return wave_table_list, path_list
 
 
-# play it with "timidity output.mid" /etc/timidity/freepats.cfg
-# see eg /usr/share/midi/freepats/Tone_000/004_Electric_Piano_1_Rhodes.pat
+@instrumentation.stage('ptn2midi.read_wav_frames')
+def read_wav_frames(infile_path, start_frame, end_frame):
+    in_file = wave.open(infile_path, "r")
+    try:
+        params = in_file.getparams()
+        in_file.setpos(start_frame)
+        frames = in_file.readframes(int(end_frame - start_frame))
+    finally:
+        in_file.close()
+    instrumentation.bytes_read(len(frames))
+    return params, frames
+
+
+@instrumentation.stage('ptn2midi.write_wav_frames')
+def write_wav_frames(outfile_path, channels, sample_width, frame_rate, frames):
+    out_file = wave.open(outfile_path, "w")
+    out_file.setnchannels(channels)
+    out_file.setsampwidth(sample_width)
+    out_file.setframerate(frame_rate)
+    out_file.writeframes(frames)
+    out_file.close()
+    instrumentation.bytes_written(len(frames))
+
 
 # via http://ubuntuforums.org/showthread.php?t=1882580
 def trim_wav_by_frame_numbers(infile_path, outfile_path, start_frame, end_frame):
-    in_file = wave.open(infile_path, "r")
-    out_file = wave.open(outfile_path, "w")
-    out_length_frames = int(end_frame - start_frame)
-    out_file.setparams((in_file.getnchannels(), in_file.getsampwidth(), in_file.getframerate(), out_length_frames,
-                        in_file.getcomptype(), in_file.getcompname()))
-    in_file.setpos(start_frame)
-    out_file.writeframes(in_file.readframes(out_length_frames))
+    params, frames = read_wav_frames(infile_path, start_frame, end_frame)
+    write_wav_frames(outfile_path, params.nchannels, params.sampwidth, params.framerate, frames)
+
+
+# little-endian PCM (unsigned if 8 bit, as in WAV) to an int64 array of samples and back
+def pcm_to_samples(data, sample_width):
+    if sample_width == 3:
+        raw = numpy.frombuffer(data, numpy.uint8).reshape(-1, 3).astype(numpy.int64)
+        samples = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        return samples - ((samples & 0x800000) << 1)
+    if sample_width == 1:
+        return numpy.frombuffer(data, numpy.uint8).astype(numpy.int64) - 128
+    return numpy.frombuffer(data, '<i%d' % sample_width).astype(numpy.int64)
+
+
+def samples_to_pcm(samples, sample_width):
+    if sample_width == 3:
+        return samples.astype('<i4').view(numpy.uint8).reshape(-1, 4)[:, :3].tobytes()
+    if sample_width == 1:
+        return (samples + 128).astype(numpy.uint8).tobytes()
+    return samples.astype('<i%d' % sample_width).tobytes()
+
+
+# pcm_to_samples without numpy, a list of ints
+def pcm_to_sample_list(data, sample_width):
+    offset = 128 if sample_width == 1 else 0
+    return [int.from_bytes(data[i:i + sample_width], 'little', signed=sample_width > 1) - offset
+            for i in range(0, len(data) - sample_width + 1, sample_width)]
+
+
+# averages the interleaved channels of a block of PCM frames into one channel, rounding down like pydub does
+@instrumentation.stage('ptn2midi.downmix_to_mono')
+def downmix_to_mono(frames, channels, sample_width):
+    if channels == 1:
+        return frames
+    if load_numpy() is not None:
+        samples = pcm_to_samples(frames, sample_width)
+        samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels)
+        return samples_to_pcm(samples.sum(axis=1) // channels, sample_width)
+    offset = 128 if sample_width == 1 else 0
+    samples = pcm_to_sample_list(frames, sample_width)
+    mono = bytearray()
+    for frame in zip(*[samples[channel::channels] for channel in range(channels)]):
+        mono += (sum(frame) // channels + offset).to_bytes(sample_width, 'little', signed=sample_width > 1)
+    return bytes(mono)
 
 
 def stereo_to_mono(infile_path, outfile_path):
-    sound = AudioSegment.from_wav(infile_path)
-    sound = sound.set_channels(1)
-    sound.export(outfile_path, format="wav")
+    with wave.open(infile_path, "r") as in_file:
+        frame_count = in_file.getnframes()
+    trim_and_downmix(infile_path, outfile_path, 0, frame_count)
+
+
+# trims a sample and downmixes it to mono in memory, writing only the mono result
+def trim_and_downmix(infile_path, outfile_path, start_frame, end_frame):
+    params, frames = read_wav_frames(infile_path, start_frame, end_frame)
+    write_wav_frames(outfile_path, 1, params.sampwidth, params.framerate,
+                     downmix_to_mono(frames, params.nchannels, params.sampwidth))
 
 
+# trims and downmixes a pad sample into work_dir, returning the path of the result.
+# with a sample cache the result is reused for as long as the source file and trim points stay the same.
+@instrumentation.stage('ptn2midi.prepare_sample')
+def prepare_sample(infile_path, start_frame, end_frame, work_dir, sample_cache=None):
+    outfile_path = work_dir + os.path.basename(infile_path) + "_mono.wav"
+    if sample_cache is None:
+        trim_and_downmix(infile_path, outfile_path, start_frame, end_frame)
+    else:
+        sample_cache.get(infile_path, start_frame, end_frame, outfile_path,
+                         lambda path: trim_and_downmix(infile_path, path, start_frame, end_frame))
+    return outfile_path
+
+
+# on-disk cache of prepared pad samples, shared between runs and processes.
+# entries are keyed by the content hash of the source file plus the trim points and SAMPLE_CACHE_FORMAT;
+# the content hash itself is remembered per (path, size, mtime) so unchanged sources are not re-read.
+# once the cache grows past size_limit bytes the least recently used entries are removed.
+class SampleCache:
+    def __init__(self, directory=SAMPLE_CACHE_DIRECTORY, size_limit=SAMPLE_CACHE_SIZE_LIMIT):
+        self.directory = directory
+        self.size_limit = size_limit
+        self.sources_directory = os.path.join(directory, 'sources')
+        self.samples_directory = os.path.join(directory, 'samples')
+        os.makedirs(self.sources_directory, exist_ok=True)
+        os.makedirs(self.samples_directory, exist_ok=True)
+
+    @instrumentation.stage('ptn2midi.SampleCache.source_hash')
+    def source_hash(self, path):
+        stat = os.stat(path)
+        identity = "%s\0%d\0%d" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        identity_path = os.path.join(self.sources_directory, hashlib.sha1(identity.encode('utf-8')).hexdigest())
+        try:
+            with open(identity_path) as identity_file:
+                return identity_file.read().strip()
+        except OSError:
+            pass
+        content_hash = hashlib.sha1()
+        with open(path, 'rb') as source_file:
+            for block in iter(lambda: source_file.read(1024 * 1024), b''):
+                content_hash.update(block)
+                instrumentation.bytes_read(len(block))
+
+        def write_hash(tmp_path):
+            with open(tmp_path, 'w') as identity_file:
+                identity_file.write(content_hash.hexdigest())
+
+        self.write_atomically(identity_path, write_hash)
+        return content_hash.hexdigest()
+
+    def entry_path(self, path, start_frame, end_frame):
+        key = "%s\0%d\0%d\0%s" % (self.source_hash(path), start_frame, end_frame, SAMPLE_CACHE_FORMAT)
+        return os.path.join(self.samples_directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.wav')
+
+    # copies the cached sample to outfile_path, calling create(outfile_path) and storing the result on a miss.
+    # entries are only ever copied out, so another process evicting them can not break a running conversion.
+    @instrumentation.stage('ptn2midi.SampleCache.get')
+    def get(self, path, start_frame, end_frame, outfile_path, create):
+        cached_path = self.entry_path(path, start_frame, end_frame)
+        try:
+            shutil.copyfile(cached_path, outfile_path)
+            os.utime(cached_path)  # mark as recently used
+            return
+        except FileNotFoundError:
+            pass
+        create(outfile_path)
+        self.write_atomically(cached_path, lambda tmp_path: shutil.copyfile(outfile_path, tmp_path))
+        self.evict()
+
+    def write_atomically(self, final_path, write):
+        tmp_path = final_path + '.tmp%d.%d' % (os.getpid(), threading.get_ident())
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, final_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        for filename in os.listdir(self.samples_directory):
+            if not filename.endswith('.wav'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.samples_directory, filename))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, filename))
+            total_size += stat.st_size
+        entries.sort()
+        for mtime, size, filename in entries:
+            if total_size <= self.size_limit:
+                break
+            try:
+                os.remove(os.path.join(self.samples_directory, filename))
+            except OSError:
+                pass
+            total_size -= size
+
+
+@instrumentation.stage('ptn2midi.create_template')
 def create_template(pattern, wave_table_list, path_list):
+    import pysf
+
+    date = today()
+    sound_font = pysf.SoundFont(Name="PySF", Song="PySF", Date=date, Product="SBAWE32", Software="PySF",
+                                Major=2, Minor=1)
+    add_pattern_preset(sound_font, 1, pattern, date, range(1, len(wave_table_list) + 1))
+    for wave_table_id, (wave_table, wave_table_path) in enumerate(zip(wave_table_list, path_list), 1):
+        add_wave_table(sound_font, wave_table_id, wave_table, wave_table_path)
+
+    return sound_font
+
+
+# adds instrument and preset number for a pattern, mapping its wavetables to one key each from C1 up in the order
+# create_midi_file gives them pitches. a pattern without wavetables gets neither, it would have no valid key range
+def add_pattern_preset(sound_font, number, pattern, date, wave_table_ids):
+    import pysf
+
+    if not wave_table_ids:
+        return
     instrument_name = "PTN_" + pattern.upper() + " " + date
     begin_key = 36
-    end_key = begin_key + len(wave_table_list) - 1
-    key_value = begin_key
-    wave_table_id = 1
-    zones = []
-    wavetables = []
-    xml_data = ElementTree.Element('sf:pysf')
-    xml_data.set('xmlns:sf', '.')
-    xml_data.set('xmlns:xsi', 'http://www.w3.org/2001/XMLSchema-instance')
-    xml_data.set('version', '3')
-    xml_data.set('xsi:schemaLocation', '.')
-    sf2 = ElementTree.SubElement(xml_data, 'sf2')
-    ElementTree.SubElement(sf2, 'ICRD').text = date
-    ifil = ElementTree.SubElement(sf2, 'IFIL')
-    major = ElementTree.SubElement(ifil, 'major')
-    minor = ElementTree.SubElement(ifil, 'minor')
-    major.text = "2"
-    minor.text = "1"
-    ElementTree.SubElement(sf2, 'INAM').text = "PySF"
-    ElementTree.SubElement(sf2, 'IPRD').text = "SBAWE32"
-    ElementTree.SubElement(sf2, 'ISFT').text = "PySF"
-    ElementTree.SubElement(sf2, 'ISNG').text = "PySF"
-    instruments = ElementTree.SubElement(sf2, 'instruments')
-    instrument = ElementTree.SubElement(instruments, 'instrument')
-    ElementTree.SubElement(instrument, 'id').text = "1"
-    ElementTree.SubElement(instrument, 'name').text = instrument_name
-    instrument_zones = ElementTree.SubElement(instrument, 'zones')
-    presets = ElementTree.SubElement(sf2, 'presets')
-    preset = ElementTree.SubElement(presets, 'preset')
-    ElementTree.SubElement(preset, 'bank').text = "128"
-    ElementTree.SubElement(preset, 'id').text = "1"
-    ElementTree.SubElement(preset, 'name').text = instrument_name
-    preset_zones = ElementTree.SubElement(preset, 'zones')
-    preset_zone = ElementTree.SubElement(preset_zones, 'zone')
-    ElementTree.SubElement(preset_zone, 'instrumentId').text = "1"
-    key_range = ElementTree.SubElement(preset_zone, 'keyRange')
-    ElementTree.SubElement(key_range, 'begin').text = str(begin_key)
-    ElementTree.SubElement(key_range, 'end').text = str(end_key)
-    wave_tables = ElementTree.SubElement(sf2, 'wavetables')
-
-    for wave_table in wave_table_list:
-        wave_table_name = wave_table.replace(".wav", "").replace(".aiff", "")
-
-        instrument_zone = ElementTree.SubElement(instrument_zones, 'zone')
-        instrument_key_range = ElementTree.SubElement(instrument_zone, 'keyRange')
-
-        ElementTree.SubElement(instrument_key_range, 'begin').text = str(key_value)
-        ElementTree.SubElement(instrument_key_range, 'end').text = str(key_value)
-        ElementTree.SubElement(instrument_zone, 'overridingRootKey').text = str(key_value)
-        ElementTree.SubElement(instrument_zone, 'sampleModes').text = '0_LoopNone'
-        ElementTree.SubElement(instrument_zone, 'wavetableId').text = str(wave_table_id)
-
-        wave_table_data = ElementTree.SubElement(wave_tables, 'wavetable')
-        ElementTree.SubElement(wave_table_data, 'file').text = path_list[wave_table_id - 1]
-        ElementTree.SubElement(wave_table_data, 'id').text = str(wave_table_id)
-        loop = ElementTree.SubElement(wave_table_data, 'loop')
-        ElementTree.SubElement(loop, 'begin').text = "1"
-        ElementTree.SubElement(loop, 'end').text = "1"
-        ElementTree.SubElement(wave_table_data, 'name').text = wave_table_name
-        key_value = key_value + 1
-        wave_table_id = wave_table_id + 1
-
-    with open("/tmp/pysftemplate.xml", "w") as file:
-        file.write("<?xml version=\"1.0\" ?>" + ElementTree.tostring(xml_data).decode("utf-8"))
-
-
-def create_soundfont_file(pattern):
-    pysf.XmlToSf("/tmp/pysftemplate.xml", "PTN_" + pattern.upper() + ".sf2")
+    end_key = begin_key + len(wave_table_ids) - 1
+    instrument = sound_font.InstrumentAdd(pysf.Instrument(number, instrument_name))
+    preset = sound_font.PresetAdd(pysf.Preset(number, instrument_name, Bank=128))
+    preset.ZoneAdd(pysf.Zone(InstrumentId=number, KeyRange=(begin_key, end_key)))
+    for key_value, wave_table_id in enumerate(wave_table_ids, begin_key):
+        instrument.ZoneAdd(pysf.Zone(WavetableId=wave_table_id, KeyRange=(key_value, key_value),
+                                     overridingRootKey=key_value, sampleModes='0_LoopNone'))
+
+
+def add_wave_table(sound_font, wave_table_id, wave_table, wave_table_path):
+    import pysf
+
+    wave_table_name = wave_table.replace(".wav", "").replace(".aiff", "")
+    sound_font.WavetableAdd(pysf.Wavetable(wave_table_id, wave_table_path, Name=wave_table_name, Loop=(1, 1)))
+
+
+@instrumentation.stage('ptn2midi.create_soundfont_file')
+def create_soundfont_file(pattern, sound_font, output_dir=""):
+    sound_font.Write(output_dir + "PTN_" + pattern.upper() + ".sf2")
+
+
+# runs the whole MIDI + SoundFont pipeline for one pattern using already parsed pad info.
+# intermediate files go to a private scratch directory so that several patterns can be converted at once.
+@instrumentation.stage('ptn2midi.convert_pattern')
+def convert_pattern(pads, path, pattern, midi_tempo, sampleformat, output_dir="", sample_cache=None):
+    work_dir = tempfile.mkdtemp(prefix="ptn2midi_" + pattern.upper() + "_") + "/"
+    try:
+        notes = get_pattern(path, pattern)
+        wave_table_list, path_list = create_midi_file(pads, notes, midi_tempo, path, pattern, sampleformat,
+                                                      work_dir, output_dir, sample_cache)
+        sound_font = create_template(pattern, wave_table_list, path_list)
+        create_soundfont_file(pattern, sound_font, output_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return pattern
+
+
+# one MIDI file and one SoundFont for several patterns, written to output_dir + name + ".mid" and ".sf2".
+# every pad sample the patterns play is stored once. the patterns that play samples get instruments and presets
+# numbered from 1 in pattern order (preset n is program n - 1), keyed like their own PTN_<name>.sf2. the MIDI file
+# plays the patterns one after the other, each on its own track starting with a program change to its preset.
+@instrumentation.stage('ptn2midi.convert_merged')
+def convert_merged(path, patterns, midi_tempo, sampleformat, name, output_dir=""):
+    import pysf
+    from midiutil.MidiFile import MIDIFile
+
+    date = today()
+    midi_file = MIDIFile(numTracks=len(patterns))
+    midi_file.addTempo(track=0, time=0, tempo=midi_tempo)
+    sound_font = pysf.SoundFont(Name="PySF", Song="PySF", Date=date, Product="SBAWE32", Software="PySF",
+                                Major=2, Minor=1)
+    sample_number_to_wave_table_id = {}  # None for samples missing from the card
+    wave_table_count = 0
+    preset_count = 0
+    start_tick = 0
+    for track, pattern in enumerate(patterns):
+        notes = get_pattern(path, pattern)
+        sample_numbers = notes.sample_numbers()
+        sample_number_to_pitch = {}
+        wave_table_ids = []
+        for sample_number in sample_numbers:
+            sample_number = int(sample_number)
+            if not sample_number or sample_number in sample_number_to_pitch:
+                continue
+            if sample_number not in sample_number_to_wave_table_id:
+                note_path = path + SAMPLE_DIRECTORY + pad_number_to_filename(sample_number, sampleformat)
+                if os.path.isfile(note_path):
+                    wave_table_count += 1
+                    wave_table_id = wave_table_count
+                    add_wave_table(sound_font, wave_table_id, os.path.basename(note_path), note_path)
+                else:
+                    print("skipping missing sample", note_path)
+                    wave_table_id = None
+                sample_number_to_wave_table_id[sample_number] = wave_table_id
+            wave_table_id = sample_number_to_wave_table_id[sample_number]
+            if wave_table_id is not None:
+                sample_number_to_pitch[sample_number] = 36 + len(wave_table_ids)
+                wave_table_ids.append(wave_table_id)
+        midi_file.addTrackName(track=track, time=0,
+                               trackName="Roland SP404SX Pattern " + pattern.upper() + " " + date)
+        if wave_table_ids:
+            add_pattern_preset(sound_font, preset_count + 1, pattern, date, wave_table_ids)
+            midi_file.addProgramChange(track, 0, start_tick / (PPQ * 1.0), preset_count)
+            preset_count += 1
+        for sample_number, tick, length in zip(sample_numbers, notes.tick, notes.length):
+            if int(sample_number) in sample_number_to_pitch:
+                midi_file.addNote(track=track, channel=0, pitch=sample_number_to_pitch[int(sample_number)],
+                                  time=(start_tick + tick) / (PPQ * 1.0), duration=length / (PPQ * 1.0),
+                                  volume=100)
+        start_tick += int(notes.end_tick)
+
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    binfile = open(output_dir + name + ".mid", 'wb')
+    midi_file.writeFile(binfile)
+    instrumentation.bytes_written(binfile.tell())
+    binfile.close()
+    sound_font.Write(output_dir + name + ".sf2")
+
+
+# pattern tick (PPQ per beat) to frame number at a tempo in beats per minute
+def tick_to_frame(tick, midi_tempo, frame_rate=RENDER_FRAME_RATE):
+    return int(tick) * 60 * frame_rate // (PPQ * midi_tempo)
+
+
+# a pad sample ready to be mixed: trimmed, downmixed to mono, reversed if the pad plays in reverse, resampled to
+# frame_rate (nearest frame) and scaled by the pad volume to floats around -1.0..1.0.
+# a numpy float64 array when numpy is installed, array.array('d') otherwise. None if the sample is missing.
+@instrumentation.stage('ptn2midi.load_voice')
+def load_voice(pads, path, sample_number, sampleformat, frame_rate=RENDER_FRAME_RATE):
+    sample_path = path + SAMPLE_DIRECTORY + pad_number_to_filename(sample_number, sampleformat)
+    if not os.path.isfile(sample_path):
+        print("skipping missing sample", sample_path)
+        return None
+    pad = pads[sample_number]
+    start_frame, end_frame = pads.trim_range(sample_number)
+    params, frames = read_wav_frames(sample_path, start_frame, end_frame)
+    frames = downmix_to_mono(frames, params.nchannels, params.sampwidth)
+    gain = pad.volume / 127.0 / (1 << (8 * params.sampwidth - 1))
+    if load_numpy() is not None:
+        samples = pcm_to_samples(frames, params.sampwidth) * gain
+        if params.framerate != frame_rate:
+            samples = samples[numpy.arange(len(samples) * frame_rate // params.framerate) * params.framerate //
+                              frame_rate]
+        return samples[::-1] if pad.reverse else samples
+    samples = [sample * gain for sample in pcm_to_sample_list(frames, params.sampwidth)]
+    if params.framerate != frame_rate:
+        samples = [samples[frame * params.framerate // frame_rate]
+                   for frame in range(len(samples) * frame_rate // params.framerate)]
+    if pad.reverse:
+        samples.reverse()
+    return array.array('d', samples)
+
+
+# (start frame, samples, gain) of every note of a pattern that has a sample, in start order, for a pattern starting
+# at start_tick. samples are shared between the notes of a pad (and, through loaded, between patterns) and cut to the
+# note length for gated pads; gain is the note velocity
+def pattern_voices(pads, path, notes, midi_tempo, sampleformat, frame_rate=RENDER_FRAME_RATE, start_tick=0,
+                   loaded=None):
+    if loaded is None:
+        loaded = {}
+    voices = []
+    for sample_number, tick, length, velocity in zip(notes.sample_numbers(), notes.tick, notes.length,
+                                                     notes.velocity):
+        sample_number = int(sample_number)
+        if not sample_number:
+            continue
+        if sample_number not in loaded:
+            loaded[sample_number] = load_voice(pads, path, sample_number, sampleformat, frame_rate)
+        samples = loaded[sample_number]
+        if samples is None:
+            continue
+        if pads[sample_number].gate:
+            samples = samples[:tick_to_frame(length, midi_tempo, frame_rate)]
+        voices.append((tick_to_frame(start_tick + int(tick), midi_tempo, frame_rate), samples, int(velocity) / 127.0))
+    return voices
+
+
+# sums the voices into frames first_frame to first_frame + frame_count of RENDER_SAMPLE_WIDTH mono PCM, clipping at
+# full scale. with numpy every voice is added to the mix as one array operation.
+@instrumentation.stage('ptn2midi.mix_voices')
+def mix_voices(voices, frame_count, first_frame=0):
+    full_scale = (1 << (8 * RENDER_SAMPLE_WIDTH - 1)) - 1
+    last_frame = first_frame + frame_count
+    if load_numpy() is not None:
+        mix = numpy.zeros(frame_count)
+        for start, samples, gain in voices:
+            begin = max(start, first_frame)
+            end = min(start + len(samples), last_frame)
+            if end > begin:
+                mix[begin - first_frame:end - first_frame] += samples[begin - start:end - start] * gain
+        return samples_to_pcm(numpy.rint(numpy.clip(mix, -1.0, 1.0) * full_scale), RENDER_SAMPLE_WIDTH)
+    mix = array.array('d', bytes(8 * frame_count))
+    for start, samples, gain in voices:
+        begin = max(start, first_frame)
+        for frame in range(begin, min(start + len(samples), last_frame)):
+            mix[frame - first_frame] += samples[frame - start] * gain
+    pcm = array.array('h', [round(max(-1.0, min(1.0, sample)) * full_scale) for sample in mix])
+    if sys.byteorder != 'little':
+        pcm.byteswap()
+    return pcm.tobytes()
+
+
+# the patterns played one after the other, mixed as RENDER_SAMPLE_WIDTH mono PCM blocks of block_frames frames
+# (the last one shorter). the audio lasts until the end of the last pattern or of the last sample if that is later.
+# patterns can be any iterable of names and are read, and their samples loaded, when the mix reaches them; each
+# block only mixes the voices sounding in it, so memory use does not grow with the length of the chain.
+def render_blocks(pads, path, patterns, midi_tempo, sampleformat, block_frames=RENDER_BLOCK_FRAMES,
+                  frame_rate=RENDER_FRAME_RATE):
+    patterns = iter(patterns)
+    patterns_left = True
+    next_start_tick = 0  # of the pattern not reached yet
+    loaded = {}
+    waiting = deque()  # voices of the patterns reached, not started yet
+    active = []
+    block_start = 0
+    while True:
+        block_end = block_start + block_frames
+        while patterns_left and tick_to_frame(next_start_tick, midi_tempo, frame_rate) < block_end:
+            pattern = next(patterns, None)
+            if pattern is None:
+                patterns_left = False
+                break
+            notes = get_pattern(path, pattern)
+            waiting.extend(pattern_voices(pads, path, notes, midi_tempo, sampleformat, frame_rate, next_start_tick,
+                                          loaded))
+            next_start_tick += int(notes.end_tick)
+        while waiting and waiting[0][0] < block_end:
+            active.append(waiting.popleft())
+        if not patterns_left and not waiting:
+            block_end = min(block_end, max([tick_to_frame(next_start_tick, midi_tempo, frame_rate)] +
+                                           [start + len(samples) for start, samples, gain in active]))
+            if block_end <= block_start:
+                return
+        yield mix_voices(active, block_end - block_start, block_start)
+        active = [voice for voice in active if voice[0] + len(voice[1]) > block_end]
+        block_start = block_end
+
+
+# canonical 44 byte header of a PCM WAV file
+def wav_header(channels, sample_width, frame_rate, data_size):
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', min(36 + data_size, 0xFFFFFFFF), b'WAVE', b'fmt ', 16, 1,
+                       channels, frame_rate, channels * sample_width * frame_rate, channels * sample_width,
+                       8 * sample_width, b'data', data_size)
+
+
+# writes blocks of mono RENDER_SAMPLE_WIDTH PCM to out as a WAV stream, each block as soon as it is mixed.
+# out is a binary file, a pipe or a socket (anything with sendall is written through it). the sizes in the header
+# are patched at the end when out is seekable and otherwise left at the maximum, which players read as "up to the
+# end of the stream". returns the number of audio bytes written.
+@instrumentation.stage('ptn2midi.stream_wav')
+def stream_wav(blocks, out, frame_rate=RENDER_FRAME_RATE):
+    write = getattr(out, 'sendall', None) or out.write
+    flush = getattr(out, 'flush', None)
+    try:
+        header_position = out.tell() if out.seekable() else None
+    except (AttributeError, OSError):
+        header_position = None
+    write(wav_header(1, RENDER_SAMPLE_WIDTH, frame_rate, 0xFFFFFFFF))
+    data_size = 0
+    for block in blocks:
+        write(block)
+        if flush is not None:
+            flush()
+        data_size += len(block)
+    if header_position is not None:
+        end_position = out.tell()
+        out.seek(header_position)
+        out.write(wav_header(1, RENDER_SAMPLE_WIDTH, frame_rate, data_size))
+        out.seek(end_position)
+    instrumentation.bytes_written(len(wav_header(1, RENDER_SAMPLE_WIDTH, frame_rate, 0)) + data_size)
+    return data_size
+
+
+# mixes a pattern down to output_dir + "PTN_" + pattern + ".wav" without going through MIDI and a SoundFont:
+# every note plays its pad sample at the note's velocity and the pad's volume, reversed for reverse pads and cut at
+# the note end for gated pads. the file lasts until the end of the pattern or of the last sample if that is later.
+@instrumentation.stage('ptn2midi.render_pattern')
+def render_pattern(pads, path, pattern, midi_tempo, sampleformat, output_dir="", frame_rate=RENDER_FRAME_RATE):
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    outfile_path = output_dir + "PTN_" + pattern.upper() + ".wav"
+    try:
+        with open(outfile_path, 'wb') as out:
+            stream_wav(render_blocks(pads, path, [pattern], midi_tempo, sampleformat, frame_rate=frame_rate), out,
+                       frame_rate)
+    except Exception:
+        # the pattern is only read once the stream has started, so don't leave a bare header behind
+        os.remove(outfile_path)
+        raise
+    return pattern
+
+
+# mixes the patterns one after the other into one WAV stream written to out (see stream_wav) as it is rendered
+@instrumentation.stage('ptn2midi.render_chain')
+def render_chain(pads, path, patterns, midi_tempo, sampleformat, out, block_frames=RENDER_BLOCK_FRAMES,
+                 frame_rate=RENDER_FRAME_RATE):
+    return stream_wav(render_blocks(pads, path, patterns, midi_tempo, sampleformat, block_frames, frame_rate), out,
+                      frame_rate)
+
+
+worker_pads = None
+
+
+def init_worker(pads, profile=False):
+    global worker_pads
+    worker_pads = pads
+    if profile:
+        instrumentation.reset()  # forked workers start with a copy of the parent's counters
+        instrumentation.enable()
+
+
+# returns the instrumentation report of the pattern when profiling, None otherwise
+def convert_pattern_worker(path, pattern, midi_tempo, sampleformat, output_dir, sample_cache):
+    pattern_output_dir = output_dir + "PTN_" + pattern.upper() + "/"
+    os.makedirs(pattern_output_dir, exist_ok=True)
+    convert_pattern(worker_pads, path, pattern, midi_tempo, sampleformat, pattern_output_dir, sample_cache)
+    return instrumentation.take() if instrumentation.enabled else None
+
+
+# converts many patterns of one card. PAD_INFO.BIN is parsed once and handed to each worker process when it
+# starts; every pattern is written to its own OUTPUT_DIR/PTN_<name>/ directory.
+# returns a dict of pattern name -> error for the patterns that failed.
+# while instrumentation is enabled the workers' counters are added to this process's.
+def convert_patterns(path, patterns, midi_tempo, sampleformat, output_dir="", jobs=None, sample_cache=None):
+    import concurrent.futures
+
+    pads = get_pad_info(path)
+    failures = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                                initargs=(pads, instrumentation.enabled)) as executor:
+        futures = {}
+        for pattern in patterns:
+            future = executor.submit(convert_pattern_worker, path, pattern, midi_tempo, sampleformat, output_dir,
+                                     sample_cache)
+            futures[future] = pattern
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                worker_report = future.result()
+                if worker_report is not None:
+                    instrumentation.merge(worker_report)
+            except (Exception, SystemExit) as error:
+                failures[futures[future]] = error
+    return failures
 
 
 def parsepath(path):
-    if path[:-1] != "/":
+    if path[-1:] != "/":
         path = path + "/"
     return path
 
 
+def print_summary(patterns, failures):
+    print("converted", len(patterns) - len(failures), "of", len(patterns), "patterns")
+    for pattern in patterns:
+        if pattern in failures:
+            print("failed", pattern.upper() + ":", repr(failures[pattern]))
+
+
+def main(argv=None):
+    import argparse
+
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(
+        description=argument_description)
+    parser.add_argument('SD_ROOT',
+                        help=sd_root_help)
+    parser.add_argument('PATTERN_NAME', help="The name of the pattern e.g. 'a1', a comma-separated list of "
+                                             "pattern names e.g. 'a1,a2,b12', or 'all' for every pattern on the card")
+    parser.add_argument('TEMPO', help="The tempo in beats per minute e.g. '95'")
+    parser.add_argument('SAMPLE_FORMAT', help="Sample format - WAV or AIFF")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="Number of worker processes used when converting several patterns "
+                             "(default: number of CPUs)")
+    parser.add_argument('--output-dir', default=".",
+                        help="Directory the per-pattern outputs are written to when converting several patterns")
+    parser.add_argument('--merge', metavar='NAME',
+                        help="Write all the patterns to one NAME.mid and one NAME.sf2 in the output directory, "
+                             "storing every pad sample once")
+    parser.add_argument('--render', action='store_true',
+                        help="Mix every pattern down to PTN_<name>.wav in the output directory instead of writing "
+                             "MIDI and SoundFont files")
+    parser.add_argument('--stream', metavar='FILE',
+                        help="Mix the patterns one after the other into one WAV written to FILE while it is "
+                             "rendered, '-' for standard output")
+    parser.add_argument('--cache-dir', default=SAMPLE_CACHE_DIRECTORY,
+                        help="Directory of the trimmed sample cache (default: %(default)s)")
+    parser.add_argument('--cache-size', type=int, default=SAMPLE_CACHE_SIZE_LIMIT // (1024 * 1024),
+                        help="Size limit of the trimmed sample cache in megabytes (default: %(default)s)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Trim every sample again instead of using the trimmed sample cache")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="Write the time, calls and bytes read and written of every stage to FILE as JSON")
+    if len(argv) < 3:
+        parser.print_help()
+        return 1
+    args = parser.parse_args(argv)
+    if args.profile is None:
+        return convert_from_args(args)
+    instrumentation.enable()
+    start = time.perf_counter()
+    try:
+        return convert_from_args(args)
+    finally:
+        instrumentation.write_report(args.profile, {'wall_seconds': time.perf_counter() - start, 'argv': argv})
+
+
+def convert_from_args(args):
+    pattern_tempo = int(args.TEMPO)
+    file_path = parsepath(args.SD_ROOT)
+    sample_format = args.SAMPLE_FORMAT
+    cache = None
+    if not args.no_cache:
+        cache = SampleCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    if args.PATTERN_NAME.lower() == "all":
+        pattern_names = list_patterns(file_path)
+    else:
+        pattern_names = [name for name in args.PATTERN_NAME.split(",") if name]
+    if args.stream is not None:
+        pads_data = get_pad_info(file_path)
+        try:
+            if args.stream == '-':
+                render_chain(pads_data, file_path, pattern_names, pattern_tempo, sample_format, sys.stdout.buffer)
+            else:
+                with open(args.stream, 'wb') as out:
+                    render_chain(pads_data, file_path, pattern_names, pattern_tempo, sample_format, out)
+        except (ValueError, OSError) as error:
+            print(error, file=sys.stderr)
+            return 1
+    elif args.render:
+        pads_data = get_pad_info(file_path)
+        failed_patterns = {}
+        for pattern_name in pattern_names:
+            try:
+                render_pattern(pads_data, file_path, pattern_name, pattern_tempo, sample_format,
+                               parsepath(args.output_dir))
+            except (ValueError, OSError) as error:
+                failed_patterns[pattern_name] = error
+        print_summary(pattern_names, failed_patterns)
+        if len(failed_patterns) > 0:
+            return 1
+    elif args.merge is not None:
+        try:
+            convert_merged(file_path, pattern_names, pattern_tempo, sample_format, args.merge,
+                           parsepath(args.output_dir))
+        except (ValueError, OSError) as error:
+            print(error, file=sys.stderr)
+            return 1
+    elif len(pattern_names) == 1:
+        pads_data = get_pad_info(file_path)
+        try:
+            convert_pattern(pads_data, file_path, pattern_names[0], pattern_tempo, sample_format, "", cache)
+        except ValueError as error:
+            print(error)
+            return 1
+    else:
+        failed_patterns = convert_patterns(file_path, pattern_names, pattern_tempo, sample_format,
+                                           parsepath(args.output_dir), args.jobs, cache)
+        print_summary(pattern_names, failed_patterns)
+        if len(failed_patterns) > 0:
+            return 1
+    return 0
+
+
 if __name__ == "__main__":
-    pattern_tempo = int(sys.argv[3])
-    file_path = parsepath(sys.argv[1])
-    pattern_data = sys.argv[2]
-    sample_format = sys.argv[4]
-    pads_data = get_pad_info(file_path)
-    notes_data = get_pattern(file_path, pattern_data)
-    wavetable_data, path_data = create_midi_file(pads_data,
-                                                 notes_data,
-                                                 pattern_tempo,
-                                                 file_path,
-                                                 pattern_data,
-                                                 sample_format)
-    create_template(pattern_data, wavetable_data, path_data)
-    create_soundfont_file(pattern_data)
+    sys.exit(main())
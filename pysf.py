@@ -1,156 +1,159 @@
 #!/usr/bin/python
-import aifc, array, chunk, datetime, logging, math, os, os.path
-import struct, sys, tempfile, wave, xml.dom.minidom
+import array, datetime, logging, math, mmap, os, os.path
+import io, struct, sys, tempfile, wave, xml.etree.ElementTree
 from io import IOBase
 
-class SfChunkReader(chunk.Chunk):
-    Item = 0
-    Form = 'NONE'
+try:
+    # aifc is gone from Python 3.13 on, AIFF support needs it
+    import aifc
+except ImportError:
+    aifc = None
 
-    def __init__(self, Handle):
-        chunk.Chunk.__init__(self, Handle, True, False, False)
-        if self.getsize() > 3:
-            self.seek(0)
-            self.Form = self.read(4)
-            self.seek(0)
-
-    def HeaderTell(self):
-        return self.offset - 8
-
-    def DataRead(self):
-        self.seek(0)
-        return self.read()
-
-    def FormSkip(self):
-        self.seek(4)
-
-    def IsEnd(self):
-        Retval = False
-        if self.tell() >= self.getsize():
-            Retval = True
-        return Retval
+try:
+    # per-stage timing and byte counts, only when pysf sits next to ptn2midi
+    import instrumentation
+except ImportError:
+    instrumentation = None
 
-    def SubChunk(self):
-        Pos = self.tell()
-        Retval = SfChunkReader(self.file)
-        Size = Retval.getsize()
-        self.seek(Pos + 8 + Size)
-        return Retval
+# numpy takes longer to import than the rest of pysf, so it is only imported
+# once a data engine has to be picked, see NumpyLoad
+numpy = False
+
+def SfStage(Name):
+    if instrumentation == None:
+        return lambda Func: Func
+    return instrumentation.stage('pysf.' + Name)
+
+def SfBytesRead(Count):
+    if instrumentation != None:
+        instrumentation.bytes_read(Count)
+
+def SfBytesWritten(Count):
+    if instrumentation != None:
+        instrumentation.bytes_written(Count)
 
-class SfTreeItem:
+class SfRiffChunk:
     Level = None
     CkId = None
     Form = None
-    Chunk = None
+    Offset = None
+    Size = None
+    Data = None
 
-    def __init__(self, Level, CkId, Form, Chunk):
+    def __init__(self, Level, CkId, Form, Offset, Size, Data):
         self.Level = Level
         self.CkId = CkId
         self.Form = Form
-        self.Chunk = Chunk
+        self.Offset = Offset
+        self.Size = Size
+        self.Data = Data
 
-    def ChunkAssign(self, Chunk):
-        self.Chunk = Chunk
-
-class SfTree:
-    Prefix = None
-    Items = None
-    Containers = None
-    Parent = None
-    Out = None
+# Memory-mapped RIFF reader. The chunk headers are walked once when the file
+# is opened and every chunk is indexed by id (containers by form type); chunk
+# data is handed out as memoryview slices of the mapping, nothing is copied.
+class SfRiff:
+    Handle = None
+    Map = None
+    View = None
+    Chunks = None
     WtPrefix = None
 
-    def __init__(self, Items, Containers, Parent, Out, WtPrefix):
-        self.Prefix = None
-        self.Items = Items
-        self.Containers = Containers
-        self.Parent = Parent
-        self.Out = Out
+    def __init__(self, FileName, WtPrefix = None):
+        self.Handle = open(FileName, 'rb')
         self.WtPrefix = WtPrefix
+        self.Chunks = {}
+        if os.fstat(self.Handle.fileno()).st_size < 12:
+            LogDie("%s: not a RIFF file" % (FileName))
+        self.Map = mmap.mmap(self.Handle.fileno(), 0, access = mmap.ACCESS_READ)
+        self.View = memoryview(self.Map)
+        self.Walk(0, len(self.View), 0)
+        Root = self.CkId('sfbk')
+        if Root == None or     \
+            Root.CkId != 'RIFF' \
+        :
+            LogDie("%s: not a SoundFont file" % (FileName))
 
-    def ChunkFind(self, Chunk, Level):
-        Retval = 'Not Found'
-        for Item in self.Items:
-            if Level != Item.Level:
-                continue
-            if Chunk.getname() != Item.CkId:
-                continue
-            if Item.Form != None and    \
-                Chunk.Form != Item.Form \
+    def Walk(self, Pos, End, Level):
+        while Pos + 8 <= End:
+            (
+                CkId,
+                Size
+            ) = struct.unpack_from('<4sI', self.View, Pos)
+            CkId = CkId.decode('latin-1')
+            DataPos = Pos + 8
+            if DataPos + Size > End:
+                logging.warn("Ck %s at %d truncated" % (CkId, Pos))
+                Size = End - DataPos
+            Form = None
+            if ListHas(SfContainers, CkId) and \
+                Size >= 4                      \
             :
-                continue
-            if Item.Chunk != None:
-                Retval = 'Duplicate'
-                break
-            Chunk.Item = Item
-            Item.ChunkAssign(Chunk)
-            Retval = 'Found'
-            break
-        return Retval
+                Form = bytes(self.View[DataPos:DataPos + 4]).decode('latin-1')
+            logging.info("Ck pos %ld, id %s, frm %s, lvl %d, len %d" % (
+                Pos,
+                CkId,
+                Form,
+                Level,
+                Size
+            ))
+            Key = Def(Form, CkId)
+            if Key in self.Chunks:
+                logging.warn("Chunk %s Duplicate" % (Key))
+            else:
+                self.Chunks[Key] = SfRiffChunk(
+                    Level,
+                    CkId,
+                    Form,
+                    DataPos,
+                    Size,
+                    self.View[DataPos:DataPos + Size]
+                )
+            if Form != None:
+                self.Walk(DataPos + 4, DataPos + Size, Level + 1)
+            Pos = DataPos + Size + Size % 2
 
-    def ChunkIsContainer(self, Chunk):
-        Retval = ListHas(self.Containers, Chunk.getname())
-        if Retval:
-            Chunk.FormSkip()
-        return Retval
+    def CkId(self, CkId):
+        return self.Chunks.get(CkId)
 
-    def CkId(self, CkId, Form, Level):
+    def CkIdStr(self, CkId):
         Retval = None
-        for Item in self.Items:
-            if Item.Chunk == None:
-                continue
-            if Level != -1 and      \
-                Level != Item.Level \
-            :
-                continue
-            if CkId != None and   \
-                CkId != Item.CkId \
-            :
-                continue
-            if Form != None and   \
-                Form != Item.Form \
-            :
-                continue
-            Retval = Item
-            break
+        Chunk = self.CkId(CkId)
+        if Chunk != None:
+            Retval = SfStrDecode(Chunk.Data)
         return Retval
 
-    def CkIdStr(self, CkId, Form, Level):
-        Retval = None
-        Item = self.CkId(CkId, Form, Level)
-        if Item != None:
-            Retval = Item.Chunk.DataRead().split('\0', 1)[0]
+    def Ifil(self):
+        Ifil = self.CkId('ifil')
+        if Ifil != None:
+            Retval = struct.unpack('<2H', Ifil.Data[0:4])
+        else:
+            Retval = (2, 1)
         return Retval
 
-    def Read(self, Chunk, Level):
-        Found = self.ChunkFind(Chunk, Level)
-        Fpos = Chunk.HeaderTell()
-        CkId = Chunk.getname()
-        Form = Chunk.Form
-        logging.info(
-            "Ck %s, pos %ld, id %c%c%c%c, frm %c%c%c%c, lvl %d, len %d" % (
-                Found,
-                Fpos,
-                CkId[0],
-                CkId[1],
-                CkId[2],
-                CkId[3],
-                Form[0],
-                Form[1],
-                Form[2],
-                Form[3],
-                Level,
-                Chunk.getsize()
-            )
-        )
-        if Found != 'Found':
-            logging.warn("Chunk %s" % (Found))
-            Chunk.close()
-        else:
-            if self.ChunkIsContainer(Chunk) == True:
-                while Chunk.IsEnd() == False:
-                    SubChunk = Chunk.SubChunk()
-                    self.Read(SubChunk, Level + 1)
+    def Close(self):
+        for Chunk in self.Chunks.values():
+            Chunk.Data.release()
+        self.View.release()
+        try:
+            self.Map.close()
+        except BufferError:
+            # a caller still holds a slice, the mapping goes away with it
+            pass
+        self.Handle.close()
+
+# file-like reader over a memoryview, used to feed RIFF chunk data to DataCopy
+class SfViewReader:
+    View = None
+    Pos = 0
+
+    def __init__(self, View):
+        self.View = View
+        self.Pos = 0
+
+    def read(self, Size):
+        Retval = self.View[self.Pos:self.Pos + Size]
+        self.Pos = self.Pos + len(Retval)
+        return Retval
 
 class SfZoneType:
     KeyN = None
@@ -161,6 +164,7 @@ class SfZoneType:
     Gen = None
     Mod = None
     Hdr = None
+    HdrCodec = None
 
     def __init__(self, ZoneTypeStr):
         if ZoneTypeStr == 'instrument':
@@ -171,6 +175,7 @@ class SfZoneType:
             self.Gen = 'igen'
             self.Mod = 'imod'
             self.Hdr = 'inst'
+            self.HdrCodec = SfInstCodec
         elif ZoneTypeStr == 'preset':
             self.KeyN = 'preset'
             self.ItemN = 'instrument'
@@ -179,22 +184,217 @@ class SfZoneType:
             self.Gen = 'pgen'
             self.Mod = 'pmod'
             self.Hdr = 'phdr'
+            self.HdrCodec = SfPhdrCodec
         else:
             raise ValueError
 
+# In-memory SoundFont model. Each class is a dict laid out exactly like the
+# corresponding part of the XML manifest, so DictToSf compiles it the same
+# way as a manifest read by XmlSf2Items and DictToXmlStr can still export it.
+class Wavetable(dict):
+    def __init__(                 \
+        self,                     \
+        Id,                       \
+        File,                     \
+        Name = None,              \
+        Loop = None,              \
+        Pitch = None,             \
+        PitchCorr = None,         \
+        Channel = None,           \
+        Link = None               \
+    ):
+        dict.__init__(self)
+        self[u'id'] = Id
+        self[u'file'] = File
+        if Name != None:
+            self[u'name'] = Name
+        if Loop != None:
+            self[u'loop'] = {
+                u'begin': Loop[0],
+                u'end': Loop[1]
+            }
+        if Pitch != None:
+            self[u'pitch'] = Pitch
+        if PitchCorr != None:
+            self[u'pitchcorr'] = PitchCorr
+        if Channel != None:
+            self[u'channel'] = Channel
+            self[u'link'] = Link
+
+class Zone(dict):
+    def __init__(                 \
+        self,                     \
+        WavetableId = None,       \
+        InstrumentId = None,      \
+        KeyRange = None,          \
+        VelRange = None,          \
+        **Generators              \
+    ):
+        dict.__init__(self, Generators)
+        if WavetableId != None:
+            self[u'wavetableId'] = WavetableId
+        if InstrumentId != None:
+            self[u'instrumentId'] = InstrumentId
+        if KeyRange != None:
+            self[u'keyRange'] = {
+                u'begin': KeyRange[0],
+                u'end': KeyRange[1]
+            }
+        if VelRange != None:
+            self[u'velRange'] = {
+                u'begin': VelRange[0],
+                u'end': VelRange[1]
+            }
+
+    def GenAdd(self, Oper, Amount):
+        if u'gens' not in self:
+            self[u'gens'] = {
+                u'gen': []
+            }
+        self[u'gens'][u'gen'].append({
+            u'comment': SfGenNames[Oper].split('_', 1)[1],
+            u'hexAmount': Amount,
+            u'oper': Oper
+        })
+
+class Instrument(dict):
+    def __init__(self, Id, Name, Zones = None):
+        dict.__init__(self)
+        self[u'id'] = Id
+        self[u'name'] = Name
+        self[u'zones'] = {
+            u'zone': list(Def(Zones, []))
+        }
+
+    def ZoneAdd(self, NewZone):
+        self[u'zones'][u'zone'].append(NewZone)
+        return NewZone
+
+class Preset(Instrument):
+    def __init__(self, Id, Name, Bank = 0, Zones = None):
+        Instrument.__init__(self, Id, Name, Zones)
+        self[u'bank'] = Bank
+
+class SoundFont(dict):
+    def __init__(                 \
+        self,                     \
+        Name = None,              \
+        Song = None,              \
+        Date = None,              \
+        Engineer = None,          \
+        Product = None,           \
+        Software = None,          \
+        Major = 2,                \
+        Minor = 1                 \
+    ):
+        dict.__init__(self)
+        for (Key, Value) in (
+            (u'INAM', Name),
+            (u'ISNG', Song),
+            (u'ICRD', Date),
+            (u'IENG', Engineer),
+            (u'IPRD', Product),
+            (u'ISFT', Software)
+        ):
+            if Value != None:
+                self[Key] = Value
+        self[u'IFIL'] = {
+            u'major': Major,
+            u'minor': Minor
+        }
+        self[u'wavetables'] = {
+            u'wavetable': []
+        }
+        self[u'instruments'] = {
+            u'instrument': []
+        }
+        self[u'presets'] = {
+            u'preset': []
+        }
+
+    def WavetableAdd(self, NewWavetable):
+        self[u'wavetables'][u'wavetable'].append(NewWavetable)
+        return NewWavetable
+
+    def InstrumentAdd(self, NewInstrument):
+        self[u'instruments'][u'instrument'].append(NewInstrument)
+        return NewInstrument
+
+    def PresetAdd(self, NewPreset):
+        self[u'presets'][u'preset'].append(NewPreset)
+        return NewPreset
+
+    def Write(self, Dst):
+        DictToSf(self, Dst)
+
+    def XmlWrite(self, Dst):
+        OutHandle = open(Dst, 'w')
+        DictToXmlFile({
+            u'sf2': self
+        }, OutHandle)
+        OutHandle.close()
+
+    @classmethod
+    def XmlRead(Cls, Src):
+        try:
+            Dict = XmlFileToDict(Src)[u'sf:pysf'][u'sf2']
+        except KeyError:
+            LogDie('Invalid input format.')
+        Retval = Cls()
+        Retval.clear()
+        Retval.update(Dict)
+        return Retval
+
+    def BinWrite(self, Dst):
+        OutHandle = open(Dst, 'wb')
+        Writer = SfBinWriter(OutHandle)
+        for (
+            Tag,
+            Value
+        ) in DictSf2Items(self):
+            Writer.Item(Tag, Value)
+        Writer.Close()
+        OutHandle.close()
+
+    @classmethod
+    def BinRead(Cls, Src):
+        Retval = Cls()
+        Retval.clear()
+        for (
+            Tag,
+            Value
+        ) in BinSf2Items(Src):
+            if Tag + u's' in XmlItemContainers:
+                Container = Retval.setdefault(Tag + u's', {})
+                Container.setdefault(Tag, []).append(Value)
+            else:
+                Retval[Tag] = Value
+        return Retval
+
 def PrintUsage():
     print("""
           pysf version """ +
           str(PysfVersion) +
           """Usage: pysf [conversion] [infile] [outfile]
                 conversion := --sf2xml | --xml2sf
+                conversion := --sf2bin | --bin2sf
+          pysf --update [old sf2] [changed ids] [infile] [outfile]
+                changed ids := comma separated ids of the wavetables with
+                               new audio e.g. 3,7, or - for none
+          pysf --list [sf2]
+          pysf --extract [sf2] [wavetable id or name] [wav outfile]
                 conversion := --aif2xml | --xml2aif
                 conversion := --wav2xml | --xml2wav
+           environment: PYSF_DATA_ENGINE=python|numpy
+                        PYSF_WORKERS=[threads writing wavetables in --sf2xml/--sf2bin]
            """)
     sys.exit(0)
 
 def ustr(Arg):
-    return str(str(Arg).encode('utf-8'))
+    return str(Arg)
+
+def SfStrDecode(Data):
+    return bytes(Data).split(b'\0', 1)[0].decode('utf-8', 'replace')
 
 def LogDie(Msg):
     logging.error(Msg)
@@ -212,37 +412,34 @@ def Def(Variable, Default):
 def Val(Dict, Key):
     if Dict == None:
         Retval = None
-    elif ListHas(Dict.keys(), Key):
-        Retval = Dict[Key]
     else:
-        Retval = None
+        Retval = Dict.get(Key)
     return Retval
 
 def ListHas(List, Item):
-    return len(list(filter(lambda x: x == Item, List))) > 0
+    return Item in List
 
-def LdFind(List, Key, Value):
-    Retval = None
-    Results = filter(lambda x: x[Key] == Value, List)
-    if len(list(Results)) > 0:
-        Retval = list(Results)[0]
-    return Retval
-
-def DataSwap(DataString):
-    DataArray = array.array('H', DataString)
-    DataArray.byteswap()
-    Retval = DataArray.tostring()
+def DataSwap(DataString, Width = 2):
+    if Width == 2:
+        DataArray = array.array('H', DataString)
+        DataArray.byteswap()
+        Retval = DataArray.tobytes()
+    else:
+        Retval = b''
+        while len(DataString) > 0:
+            Retval = Retval + DataString[Width - 1::-1]
+            DataString = DataString[Width:]
     return Retval
 
-def ChannelFilter(DataString, Channel):
-    Retval = ''
+def ChannelFilter(DataString, Channel, Width = 2):
+    Retval = b''
     while len(DataString) > 0:
-        Retval = Retval + DataString[Channel * SrcWidth:SrcWidth]
-        DataString = DataString[SrcWidth * 2:]
+        Retval = Retval + DataString[Channel * Width:(Channel + 1) * Width]
+        DataString = DataString[Width * 2:]
     return Retval
 
 def DataSplit24(DataString, SplitPart):
-    Retval = ''
+    Retval = b''
     if SplitPart == 'part16':
         RangeBegin = 1
         RangeEnd = 3
@@ -256,13 +453,71 @@ def DataSplit24(DataString, SplitPart):
 
 def DataJoin24(Data16, Data24):
     # This is little-endian because we always export as wave
-    Retval = ''
+    Retval = b''
     while len(Data16) > 0:
         Retval = Retval + Data24[0:1] + Data16[0:2]
         Data16 = Data16[2:]
         Data24 = Data24[1:]
     return Retval
 
+# numpy engine: the same transforms as strided views over the whole block
+
+def DataSwapNp(DataString, Width = 2):
+    if Width < 2:
+        return DataString
+    DataArray = numpy.frombuffer(DataString, numpy.uint8).reshape(-1, Width)
+    return DataArray[:, ::-1].tobytes()
+
+def ChannelFilterNp(DataString, Channel, Width = 2):
+    DataArray = numpy.frombuffer(DataString, numpy.uint8).reshape(-1, Width * 2)
+    return DataArray[:, Channel * Width:(Channel + 1) * Width].tobytes()
+
+def DataSplit24Np(DataString, SplitPart):
+    DataArray = numpy.frombuffer(DataString, numpy.uint8).reshape(-1, 3)
+    if SplitPart == 'part16':
+        Retval = DataArray[:, 1:3].tobytes()
+    elif SplitPart == 'part24':
+        Retval = DataArray[:, 0:1].tobytes()
+    return Retval
+
+def DataJoin24Np(Data16, Data24):
+    # This is little-endian because we always export as wave
+    Frames = len(Data16) // 2
+    DataArray = numpy.empty((Frames, 3), numpy.uint8)
+    DataArray[:, 0] = numpy.frombuffer(Data24, numpy.uint8, Frames)
+    DataArray[:, 1:3] = numpy.frombuffer(Data16, numpy.uint8).reshape(-1, 2)
+    return DataArray.tobytes()
+
+def NumpyLoad():
+    global numpy
+    if numpy is False:
+        try:
+            import numpy as NumpyModule
+        except ImportError:
+            NumpyModule = None
+        numpy = NumpyModule
+    return numpy
+
+def DataEngineSet(Engine):
+    global SfDataEngine
+    if Engine == 'numpy' and \
+        NumpyLoad() == None  \
+    :
+        LogDie('numpy data engine requested, but numpy is not installed')
+    if not ListHas(SfDataEngines.keys(), Engine):
+        LogDie("unknown data engine %s" % (Engine))
+    SfDataEngine = Engine
+
+def WorkersSet(Workers):
+    global SfWorkers
+    try:
+        Workers = int(Workers)
+    except ValueError:
+        LogDie("invalid worker count %s" % (Workers))
+    if Workers < 1:
+        LogDie("invalid worker count %d" % (Workers))
+    SfWorkers = Workers
+
 def DataCopy(         \
     Src,              \
     Dst,              \
@@ -276,115 +531,417 @@ def DataCopy(         \
        Byteswap = False
        if sys.byteorder == 'big':
             Byteswap = True
+    if SfDataEngine == None:
+        if NumpyLoad() != None: DataEngineSet('numpy')
+        else:                   DataEngineSet('python')
+    (
+        BlockFrames,
+        SwapFunc,
+        FilterFunc,
+        SplitFunc,
+        JoinFunc
+    ) = SfDataEngines[SfDataEngine]
     if type(Src) == tuple:
         S24 = Src[1]
         Src = Src[0]
     else:
         S24 = None
-    if Src.__class__ == wave.Wave_read or \
-        Src.__class__ == aifc.Aifc_read   \
+    if type(Dst) == tuple:
+        D24 = Dst[1]
+        Dst = Dst[0]
+    else:
+        D24 = None
+    if isinstance(Src, memoryview):
+        Src = SfViewReader(Src)
+    if isinstance(S24, memoryview):
+        S24 = SfViewReader(S24)
+    if Src.__class__ == wave.Wave_read or          \
+        (aifc != None and                          \
+            Src.__class__ == aifc.Aifc_read)       \
     :
         ReadFunc = Src.readframes
+        SampWidth = Src.getsampwidth()
         SrcWidth = 1
     else:
         ReadFunc = Src.read
-    if Dst.__class__ == wave.Wave_write or \
-        Dst.__class__ == aifc.Aifc_write   \
+        SampWidth = SrcWidth
+    if Dst.__class__ == wave.Wave_write or         \
+        (aifc != None and                          \
+            Dst.__class__ == aifc.Aifc_write)      \
     :
         WriteFunc = Dst.writeframesraw
     else:
         WriteFunc = Dst.write
     while FramesLeft > 0:
-        DataSize = min(FramesLeft, 1024)
+        DataSize = min(FramesLeft, BlockFrames)
         DataString = ReadFunc(int(DataSize * SrcWidth))
         if Byteswap == True:
-            DataString = DataSwap(DataString)
+            DataString = SwapFunc(DataString, SampWidth)
         if Channel == 0 or \
             Channel == 1   \
         :
-            DataString = ChannelFilter(DataString, Channel)
+            DataString = FilterFunc(DataString, Channel, SampWidth)
         if SplitPart != 'all':
-            DataString = DataSplit24(DataString, SplitPart)
+            DataString = SplitFunc(DataString, SplitPart)
+        if D24 != None:
+            D24.write(SplitFunc(DataString, 'part24'))
+            DataString = SplitFunc(DataString, 'part16')
         if S24 != None:
-            Data24 = S24.read(DataSize)
-            DataString = DataJoin24(DataString, Data24)
+            Data24 = S24.read(int(DataSize))
+            DataString = JoinFunc(DataString, Data24)
         WriteFunc(DataString)
         FramesLeft = FramesLeft - DataSize
 
-def DictToXml(Xml, XmlEl, Dict):
-    KeyList = Dict.keys()
-    KeyList.sort()
-    for Key in KeyList:
-        if type(Dict[Key]) == dict:
-            XmlSubEl = Xml.createElementNS(None, Key)
-            XmlEl.appendChild(XmlSubEl)
-            DictToXml(Xml, XmlSubEl, Dict[Key])
-        elif type(Dict[Key]) == list:
-            for SubDict in Dict[Key]:
-                XmlSubEl = Xml.createElementNS(None, Key)
-                XmlEl.appendChild(XmlSubEl)
-                DictToXml(Xml, XmlSubEl, SubDict)
-        else:
-            XmlSubEl = Xml.createElementNS(None, Key)
-            XmlEl.appendChild(XmlSubEl)
-            XmlTextEl = Xml.createTextNode(ustr(Dict[Key]))
-            XmlSubEl.appendChild(XmlTextEl)
+# Writes the same text the minidom based writer used to, toprettyxml('  ')
+# output with its lines joined up, one element at a time: keys in sorted
+# order, text inline and escaped like minidom does. Lists may be iterators,
+# their items are written as they are produced and then dropped, so memory
+# stays flat however many zones a SoundFont has.
+class SfXmlWriter:
+    Handle = None
+    Last = None
+    Count = None
 
-def DictToXmlStr(Dict):
-    Xml = xml.dom.minidom.parseString(XmlRootStr.encode('UTF-8'))
-    XmlEl = Xml.documentElement
-    DictToXml(Xml, XmlEl, Dict)
-    R = ''
-    for L in Xml.toprettyxml('  ').split('\n'):
-        if len(L) > 0 and    \
-            len(R) > 0 and   \
-            L[-1] == '>' and \
-            R[-1] == '>'     \
+    def __init__(self, Handle):
+        self.Handle = Handle
+        self.Last = u''
+        self.Count = 0
+
+    # a line ending in a tag after one ending in a tag gets its own line,
+    # anything else is stripped and run on
+    def Line(self, Str):
+        for L in Str.split('\n'):
+            if len(L) > 0 and    \
+                self.Last == '>' and \
+                L[-1] == '>'     \
+            :
+                L = u'\n' + L
+            else:
+                L = L.strip()
+            if len(L) > 0:
+                self.Handle.write(L)
+                self.Count = self.Count + len(L)
+                self.Last = L[-1]
+
+    def Element(self, Key, Value, Indent):
+        if isinstance(Value, dict):
+            if len(Value) == 0:
+                self.Line(Indent + u'<' + Key + u'/>')
+            else:
+                self.Line(Indent + u'<' + Key + u'>')
+                self.Dict(Value, Indent + u'  ')
+                self.Line(Indent + u'</' + Key + u'>')
+        elif isinstance(Value, list) or \
+            hasattr(Value, '__next__')  \
         :
-            R = R + '\n' + L
+            for SubDict in Value:
+                self.Element(Key, SubDict, Indent)
+        else:
+            self.Line(Indent + u'<' + Key + u'>' + XmlEscape(ustr(Value)) + \
+                u'</' + Key + u'>')
+
+    def Dict(self, Dict, Indent):
+        for Key in sorted(Dict.keys()):
+            self.Element(Key, Dict[Key], Indent)
+
+    def Document(self, Dict):
+        self.Line(u'<?xml version="1.0" ?>')
+        if len(Dict) == 0:
+            self.Line(XmlHeaderStr[:-1] + u'/>')
         else:
-            R = R + L.strip()
-    R = R + '\n'
-    Xml.unlink()
-    return R
+            self.Line(XmlHeaderStr)
+            self.Dict(Dict, u'  ')
+            self.Line(u'</sf:pysf>')
+        self.Handle.write(u'\n')
+        self.Count = self.Count + 1
+        return self.Count
+
+def XmlEscape(Str):
+    return Str.replace('&', '&amp;').replace('<', '&lt;'). \
+        replace('"', '&quot;').replace('>', '&gt;')
 
+@SfStage('DictToXmlFile')
+def DictToXmlFile(Dict, OutHandle):
+    Count = SfXmlWriter(OutHandle).Document(Dict)
+    SfBytesWritten(Count)
+    return Count
+
+@SfStage('DictToXmlStr')
+def DictToXmlStr(Dict):
+    OutHandle = io.StringIO()
+    SfXmlWriter(OutHandle).Document(Dict)
+    return OutHandle.getvalue()
+
+# Element -> dict the way the minidom based reader built it: the elements
+# of XmlListTags become lists, text becomes an int when it is a number.
 def XmlToDict(Xml):
-    CTags = [
-        'gen',
-        'instrument',
-        'preset',
-        'wavetable',
-        'zone'
-    ]
     Dict = {}
-    for Node in Xml.childNodes:
-        if Node.nodeType == Node.ELEMENT_NODE:
-            NewDict = XmlToDict(Node)
-            if ListHas(CTags, Node.nodeName):
-                if ListHas(Dict.keys(), Node.nodeName):
-                    Dict[Node.nodeName].append(NewDict)
-                else:
-                    Dict[Node.nodeName] = [NewDict]
+    Dict = XmlText(Dict, Xml.text)
+    for Node in Xml:
+        NewDict = XmlToDict(Node)
+        Tag = XmlLocalName(Node.tag)
+        if Tag in XmlListTags:
+            if Tag in Dict:
+                Dict[Tag].append(NewDict)
             else:
-                Dict[Node.nodeName] = NewDict
-        elif Node.nodeType == Node.TEXT_NODE:
-            Str = Node.data.strip()
-            if len(Str) > 0:
-                if Str.isdigit():
-                    Dict = int(Str)
-                elif Str[0:2] == '0x':
-                    Dict = int(Str[2:], 16)
-                else:
-                    Dict = Str
+                Dict[Tag] = [NewDict]
         else:
-            raise TypeError
+            Dict[Tag] = NewDict
+        Dict = XmlText(Dict, Node.tail)
+    return Dict
+
+def XmlText(Dict, Text):
+    if Text == None:
+        return Dict
+    Str = Text.strip()
+    if len(Str) > 0:
+        if Str.isdigit():
+            Dict = int(Str)
+        elif Str[0:2] == '0x':
+            Dict = int(Str[2:], 16)
+        else:
+            Dict = Str
     return Dict
 
+# ElementTree tag -> tag without its namespace: the manifest is read by
+# local name, whatever URI its sf: prefix is bound to (the ptn2midi template
+# used to bind it to ".")
+def XmlLocalName(Tag):
+    return Tag.rsplit('}', 1)[-1]
+
+# ElementTree tag -> tag as written in the manifest
+def XmlTagName(Tag):
+    Tag = XmlLocalName(Tag)
+    if Tag == XmlRootName:
+        return u'sf:pysf'
+    return Tag
+
+@SfStage('XmlFileToDict')
 def XmlFileToDict(FileName):
-    Xml = xml.dom.minidom.parse(FileName)
-    Retval = XmlToDict(Xml)
-    Xml.unlink()
-    return Retval
+    SfBytesRead(os.path.getsize(FileName))
+    Xml = xml.etree.ElementTree.parse(FileName).getroot()
+    return {
+        XmlTagName(Xml.tag): XmlToDict(Xml)
+    }
+
+# Reads the sf2 element of a manifest as (tag, value) pairs: one per INFO
+# element (ISNG, IFIL...) and one per wavetable, instrument and preset, each
+# yielded as soon as its end tag is parsed and then dropped from the tree,
+# so only the item being read is ever held.
+def XmlSf2Items(FileName):
+    SfBytesRead(os.path.getsize(FileName))
+    Path = []
+    Sf2Found = False
+    for (
+        Event,
+        El
+    ) in xml.etree.ElementTree.iterparse(FileName, ('start', 'end')):
+        El.tag = XmlLocalName(El.tag)
+        if Event == 'start':
+            if len(Path) == 0 and \
+                El.tag != XmlRootName \
+            :
+                LogDie('Invalid input format.')
+            Path.append(El)
+            continue
+        Path.pop()
+        if len(Path) < 2 or \
+            Path[1].tag != 'sf2' \
+        :
+            if len(Path) == 1:
+                Sf2Found = Sf2Found or El.tag == 'sf2'
+                Path[0].remove(El)
+            continue
+        if len(Path) == 2:
+            if not El.tag in XmlItemContainers:
+                yield (El.tag, XmlToDict(El))
+            Path[1].remove(El)
+        elif len(Path) == 3 and                 \
+            Path[2].tag in XmlItemContainers and \
+            El.tag == XmlItemContainers[Path[2].tag] \
+        :
+            yield (El.tag, XmlToDict(El))
+            Path[2].remove(El)
+    if not Sf2Found:
+        LogDie('Invalid input format.')
+
+# The (tag, value) pairs XmlSf2Items reads from the manifest of Dict.
+def DictSf2Items(Dict):
+    for Key in sorted(Dict.keys()):
+        if Key in XmlItemContainers:
+            Tag = XmlItemContainers[Key]
+            if isinstance(Dict[Key], dict):
+                for Item in Def(Val(Dict[Key], Tag), []):
+                    yield (Tag, Item)
+        else:
+            yield (Key, Dict[Key])
+
+# Binary manifest: the (tag, value) pairs of XmlSf2Items as length prefixed
+# records after an 8 byte header (magic, format version). Values are typed:
+# dicts and lists hold their item count, ints take 1, 2, 4 or 8 bytes and
+# strings are UTF-8. A key is written out in full the first time it is used
+# and by its index after that. A record of length 0 ends the file.
+class SfBinWriter:
+    Handle = None
+    Keys = None
+    Count = None
+
+    def __init__(self, Handle):
+        self.Handle = Handle
+        self.Keys = {}
+        self.Handle.write(SfBinHeader.pack(SfBinMagic, SfBinVersion))
+        self.Count = SfBinHeader.size
+
+    def Item(self, Tag, Value):
+        Data = bytearray()
+        self.Key(Data, Tag)
+        self.Value(Data, Value)
+        self.Handle.write(SfBinSize.pack(len(Data)))
+        self.Handle.write(Data)
+        self.Count = self.Count + SfBinSize.size + len(Data)
+
+    def Close(self):
+        self.Handle.write(SfBinSize.pack(0))
+        self.Count = self.Count + SfBinSize.size
+        return self.Count
+
+    def Key(self, Data, Key):
+        Index = self.Keys.get(Key)
+        if Index != None:
+            Data.extend(SfBinKey.pack(Index))
+            return
+        Index = len(self.Keys)
+        self.Keys[Key] = Index
+        KeyD = Key.encode('utf-8')
+        Data.extend(SfBinKey.pack(Index))
+        Data.extend(SfBinKey.pack(len(KeyD)))
+        Data.extend(KeyD)
+
+    def Value(self, Data, Value):
+        if isinstance(Value, dict):
+            Data.extend(SfBinDict.pack(b'd', len(Value)))
+            for Key in sorted(Value.keys()):
+                self.Key(Data, Key)
+                self.Value(Data, Value[Key])
+            return
+        if isinstance(Value, list):
+            Data.extend(SfBinDict.pack(b'l', len(Value)))
+            for Item in Value:
+                self.Value(Data, Item)
+            return
+        # anything else is stored as it reads back from an XML manifest,
+        # e.g. the hexAmount of a gen as an int
+        if isinstance(Value, bool) or \
+            not isinstance(Value, int) \
+        :
+            Value = XmlText({}, ustr(Value))
+        if isinstance(Value, dict):
+            Data.extend(SfBinDict.pack(b'd', 0))
+        elif isinstance(Value, int):
+            for (
+                Code,
+                Codec,
+                Min,
+                Max
+            ) in SfBinInts:
+                if Value >= Min and \
+                    Value <= Max    \
+                :
+                    Data.extend(Code)
+                    Data.extend(Codec.pack(Value))
+                    break
+            else:
+                LogDie("%d does not fit a binary manifest" % (Value))
+        else:
+            StrD = Value.encode('utf-8')
+            Data.extend(SfBinDict.pack(b's', len(StrD)))
+            Data.extend(StrD)
+
+class SfBinReader:
+    Data = None
+    Pos = 0
+    Keys = None
+
+    def __init__(self):
+        self.Keys = []
+
+    def Record(self, Data):
+        self.Data = Data
+        self.Pos = 0
+        return (self.Key(), self.Value())
+
+    def Key(self):
+        (Index,) = SfBinKey.unpack_from(self.Data, self.Pos)
+        self.Pos = self.Pos + SfBinKey.size
+        if Index == len(self.Keys):
+            (Size,) = SfBinKey.unpack_from(self.Data, self.Pos)
+            self.Pos = self.Pos + SfBinKey.size
+            self.Keys.append(self.Data[self.Pos:self.Pos + Size].decode('utf-8'))
+            self.Pos = self.Pos + Size
+        return self.Keys[Index]
+
+    def Value(self):
+        Code = self.Data[self.Pos:self.Pos + 1]
+        if Code in SfBinIntCodecs:
+            Codec = SfBinIntCodecs[Code]
+            (Value,) = Codec.unpack_from(self.Data, self.Pos + 1)
+            self.Pos = self.Pos + 1 + Codec.size
+            return Value
+        (
+            Code,
+            Count
+        ) = SfBinDict.unpack_from(self.Data, self.Pos)
+        self.Pos = self.Pos + SfBinDict.size
+        if Code == b'd':
+            Value = {}
+            for I in range(Count):
+                Key = self.Key()
+                Value[Key] = self.Value()
+        elif Code == b'l':
+            Value = [self.Value() for I in range(Count)]
+        elif Code == b's':
+            Value = self.Data[self.Pos:self.Pos + Count].decode('utf-8')
+            self.Pos = self.Pos + Count
+        else:
+            LogDie('Invalid input format.')
+        return Value
+
+# Reads a binary manifest as (tag, value) pairs like XmlSf2Items, one
+# record at a time.
+def BinSf2Items(FileName):
+    SfBytesRead(os.path.getsize(FileName))
+    InHandle = open(FileName, 'rb')
+    try:
+        (
+            Magic,
+            Version
+        ) = SfBinHeader.unpack(InHandle.read(SfBinHeader.size))
+    except struct.error:
+        LogDie('Invalid input format.')
+    if Magic != SfBinMagic:
+        LogDie('Invalid input format.')
+    if Version > SfBinVersion:
+        LogDie("binary manifest version %d, this pysf reads up to %d" % (
+            Version,
+            SfBinVersion
+        ))
+    Reader = SfBinReader()
+    while True:
+        SizeD = InHandle.read(SfBinSize.size)
+        if len(SizeD) < SfBinSize.size:
+            LogDie('truncated binary manifest')
+        (Size,) = SfBinSize.unpack(SizeD)
+        if Size == 0:
+            break
+        Data = InHandle.read(Size)
+        if len(Data) < Size:
+            LogDie('truncated binary manifest')
+        try:
+            Item = Reader.Record(Data)
+        except (struct.error, IndexError, UnicodeDecodeError):
+            LogDie('Invalid input format.')
+        yield Item
+    InHandle.close()
 
 def LikeFile(Obj):
     Retval = False
@@ -437,7 +994,9 @@ def ListToIff(List, OutHandle):
 def AudOpen(FileName, Mode, Format):
     if Format == 'wav':
         AudOpenFunc = wave.open
-    elif Format == 'aif':
+    elif Format == 'aif' and \
+        aifc != None         \
+    :
         AudOpenFunc = aifc.open
     else:
         LogDie('unsupported format')
@@ -515,61 +1074,97 @@ def SfStr(Str, MaxLen = 256):
 
     return Retval
 
-def SfWavetableList(Tree):
-    Smpl = Tree.CkId('smpl', None, -1)
+# Every record of a pdta chunk, decoded in one pass over its memoryview.
+# A trailing partial record is ignored.
+def SfRecords(Chunk, Codec):
+    Data = Chunk.Data
+    return Codec.iter_unpack(Data[:len(Data) - len(Data) % Codec.size])
+
+def SfWavetableWrite(Job):
+    (
+        FileName,
+        SampleRate,
+        SmplD,
+        Sm24D,
+        SampleCount
+    ) = Job
+    Aud = wave.open(FileName, 'wb')
+    Aud.setnchannels(1)
+    Aud.setframerate(SampleRate)
+    Aud.setnframes(SampleCount)
+    if Sm24D == None:
+        Aud.setsampwidth(2)
+        DataCopy(SmplD, Aud, 2, SampleCount)
+    else:
+        Aud.setsampwidth(3)
+        DataCopy((SmplD, Sm24D), Aud, 2, SampleCount)
+    Written = SampleCount * Aud.getsampwidth()
+    Aud.close()
+    return Written
+
+# The smpl chunk and the sm24 one, or None when the file has no usable sm24.
+def SfSampleChunks(Riff):
+    Smpl = Riff.CkId('smpl')
     if Smpl == None:
         LogDie('no wavetable data')
-    Ifil = Tree.CkId('ifil', None, -1)
-    if Ifil != None:
-        IfilD = Ifil.Chunk.DataRead()
-        (
-            Major,
-            Minor
-        ) = struct.unpack('<2H', IfilD)
-    else:
-        Major = 2
-        Minor = 1
+    (
+        Major,
+        Minor
+    ) = Riff.Ifil()
     if Major == 2 and \
         Minor >= 4    \
     :
-        Sm24 = Tree.CkId('sm24', None, -1)
+        Sm24 = Riff.CkId('sm24')
     else:
         Sm24 = None
     if Sm24 != None:
-        ExpectedSize = Smpl.Chunk.getsize() / 2
+        ExpectedSize = Smpl.Size // 2
         if ExpectedSize % 2 > 0:
             ExpectedSize = ExpectedSize + 1
-        if Sm24.Chunk.getsize() != ExpectedSize:
+        if Sm24.Size != ExpectedSize:
             logging.warn(
                 "ignoring sm24, size %d, expected %d" % (
-                    Sm24.Chunk.getsize(),
+                    Sm24.Size,
                     ExpectedSize
                 )
             )
             Sm24 = None
-    Shdr = Tree.CkId('shdr', None, -1)
+    return (Smpl, Sm24)
+
+# Every shdr record but the terminal EOS one, decoded from the mapped chunk.
+def SfShdrRecords(Riff):
+    Shdr = Riff.CkId('shdr')
     if Shdr == None:
         LogDie('no wavetable header')
-    Data = Shdr.Chunk.DataRead()
-    FmtStr = '<20s5IbB2H'
-    FmtLen = struct.calcsize(FmtStr)
+    Count = max(0, (Shdr.Size - 1) // SfShdrCodec.size)
+    return SfShdrCodec.iter_unpack(Shdr.Data[:Count * SfShdrCodec.size])
+
+# The headers are read in order first, then the wavetables are written by
+# Workers threads (SfWorkers by default) straight from views of the mapped
+# smpl/sm24 chunks, each to its own file.
+@SfStage('SfWavetableList')
+def SfWavetableList(Riff, Workers = None):
+    (
+        Smpl,
+        Sm24
+    ) = SfSampleChunks(Riff)
     Order = 0
     List = []
-    while len(Data) > 46:
-        (
-            AchSampleName,
-            DwStart,
-            DwEnd,
-            DwStartLoop,
-            DwEndLoop,
-            DwSampleRate,
-            ByOriginalPitch,
-            ChPitchCorrection,
-            WSampleLink,
-            SfSampleType
-        ) = struct.unpack(FmtStr, Data[0:FmtLen])
-        AchSampleName = AchSampleName.split('\0', 1)[0]
-        FileName = "%s%d.wav" % (Tree.WtPrefix, Order + 1)
+    Jobs = []
+    for (
+        AchSampleName,
+        DwStart,
+        DwEnd,
+        DwStartLoop,
+        DwEndLoop,
+        DwSampleRate,
+        ByOriginalPitch,
+        ChPitchCorrection,
+        WSampleLink,
+        SfSampleType
+    ) in SfShdrRecords(Riff):
+        AchSampleName = SfStrDecode(AchSampleName)
+        FileName = "%s%d.wav" % (Riff.WtPrefix, Order + 1)
         WDict = {
             u'id': Order + 1,
             u'file': FileName,
@@ -605,240 +1200,220 @@ def SfWavetableList(Tree):
         if ChPitchCorrection != 0:
             WDict[u'pitchcorr'] = ChPitchCorrection
         List.append(WDict)
-        SampleCount = DwEnd - DwStart
-        Aud = wave.open(FileName, 'wb')
-        Aud.setnchannels(1)
-        Aud.setframerate(DwSampleRate)
-        Aud.setnframes(SampleCount)
-        Smpl.Chunk.seek(DwStart * 2, 0)
         if Sm24 == None:
-            Aud.setsampwidth(2)
-            DataCopy(Smpl.Chunk, Aud, 2, SampleCount)
+            Sm24D = None
         else:
-            Sm24F = open(Sm24.Chunk.file.name, 'rb')
-            Sm24F.seek(Sm24.Chunk.offset + DwStart)
-            Aud.setsampwidth(3)
-            DataCopy((Smpl.Chunk, Sm24F), Aud, 2, SampleCount)
-            Sm24F.close()
-        Aud.close()
+            Sm24D = Sm24.Data[DwStart:DwEnd]
+        Jobs.append((
+            FileName,
+            DwSampleRate,
+            Smpl.Data[DwStart * 2:DwEnd * 2],
+            Sm24D,
+            DwEnd - DwStart
+        ))
         Order = Order + 1
-        Data = Data[FmtLen:]
+    Workers = Def(Workers, Def(SfWorkers, os.cpu_count() or 1))
+    if Workers > 1 and \
+        len(Jobs) > 1  \
+    :
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(Workers) as Executor:
+            Written = list(Executor.map(SfWavetableWrite, Jobs))
+    else:
+        Written = list(map(SfWavetableWrite, Jobs))
+    SfBytesWritten(sum(Written))
     return List
 
-def SfZoneList(Tree, Zt):
-    AchName = 'ZORKMID'
-    WBagNdx = -999
-    WBank = -999
-    Order = 0
-    Bag = Tree.CkId(Zt.Bag, None, -1)
+# Yields the instruments or presets one at a time, each decoded only when it
+# is asked for. Bag and generator records are unpacked straight from the
+# mapped chunks, so nothing is held beyond the item being yielded.
+def SfZoneList(Riff, Zt):
+    Bag = Riff.CkId(Zt.Bag)
     if Bag == None:
         LogDie("no %s section" % (Zt.Bag))
-    BagD = Bag.Chunk.DataRead()
-    BagFmtStr = '<2H'
-    BagRecLen = struct.calcsize(BagFmtStr)
-    Gen = Tree.CkId(Zt.Gen, None, -1)
+    Gen = Riff.CkId(Zt.Gen)
     if Gen == None:
         LogDie("no %s section" % (Zt.Gen))
-    GenD = Gen.Chunk.DataRead()
-    GenFmtStr = '<2H'
-    GenRecLen = struct.calcsize(GenFmtStr)
-    Hdr = Tree.CkId(Zt.Hdr, None, -1)
+    Hdr = Riff.CkId(Zt.Hdr)
     if Hdr == None:
         LogDie("no %s section" % (Zt.Gen))
-    HdrD = Hdr.Chunk.DataRead()
-    HdrFmtStr = '<20sH'
+    # the zones of a header run up to the bag index of the next one, the
+    # terminal header only closes the list
+    Order = 0
+    Prev = None
+    for Record in SfRecords(Hdr, Zt.HdrCodec):
+        if Prev != None:
+            yield SfZoneListItem(Zt, Bag.Data, Gen.Data, Order, Prev, Record)
+        Order = Order + 1
+        Prev = Record
+
+@SfStage('SfZoneList')
+def SfZoneListItem(Zt, BagD, GenD, Order, Record, NextRecord):
+    logging.info("reading %s %d", Zt.KeyN, Order)
+    (
+        AchName,
+        WPreset,
+        WBank,
+        WBagNdx
+    ) = SfHdrFields(Zt, Record)
+    NextWBagNdx = SfHdrFields(Zt, NextRecord)[3]
+    IPDict = {
+        u'id': Order,
+        u'name': SfStrDecode(AchName),
+        u'zones': {}
+    }
     if Zt.KeyN == 'preset':
-        HdrFmtStr = HdrFmtStr + '2H3I'
-    HdrFmtLen = struct.calcsize(HdrFmtStr)
-    List = []
-    while len(HdrD) > 0:
-        logging.info("reading %s %d" % (Zt.KeyN, Order + 1))
-        ZoneIndex = 1
-        LastAchName = AchName
-        LastWBagNdx = WBagNdx
-        LastWBank = WBank
-        if Zt.KeyN == 'instrument':
-            (
-                AchName,
-                WBagNdx
-            ) = struct.unpack(HdrFmtStr, HdrD[0:HdrFmtLen])
-        elif Zt.KeyN == 'preset':
+        IPDict[u'bank'] = WBank
+    ZList = []
+    for I in range(WBagNdx, NextWBagNdx):
+        # (wGenNdx, wModNdx) per zone
+        J = SfBagCodec.unpack_from(BagD, I * SfBagCodec.size)[0]
+        ZDict = {}
+        Generators = []
+        while True:
+            # (sfGenOper, genAmount as unsigned word) per generator
             (
-                AchName,
-                WPreset,
-                WBank,
-                WBagNdx,
-                DwLibrary,
-                DwGenre,
-                DwMorphology
-            ) = struct.unpack(HdrFmtStr, HdrD[0:HdrFmtLen])
-        AchName = AchName.split('\0', 1)[0]
-        HdrD = HdrD[HdrFmtLen:]
-        if Order > 0:
-            IPDict = {
-                u'id': Order,
-                u'name': LastAchName,
-                u'zones': {}
+                SfGenOper,
+                WAmount
+            ) = SfGenCodec.unpack_from(GenD, J * SfGenCodec.size)
+            # genAmount is a union of a byte range, a signed and an
+            # unsigned word, all decoded from the one unsigned word
+            RangeBegin = WAmount & 0xff
+            RangeEnd = WAmount >> 8
+            ShAmount = WAmount - 0x10000 if WAmount > 0x7fff else WAmount
+            if SfGenOper < len(SfGenNames):
+                Name = SfGenNames[SfGenOper].split('_', 1)[1]
+            else:
+                Name = 'unknown'
+            if SfGenOper == 43 or \
+                SfGenOper == 44   \
+            :
+                ZDict[ustr(Name)] = {
+                    u'begin': RangeBegin,
+                    u'end': RangeEnd
+                }
+            elif SfGenOper in SfTimecentOpers:
+                Dt = 0
+                if ShAmount != SHMIN:
+                    Dt = pow(2.0, ShAmount / 1200.0)
+                ZDict[ustr(Name)] = u'%0.04f' % (Dt)
+            elif SfGenOper in SfSignedOpers:
+                ZDict[ustr(Name)] = ShAmount
+            elif SfGenOper == 53 or \
+                SfGenOper == 41     \
+            :
+                if SfGenOper != Zt.Oper:
+                    LogDie("%s operator found in %s context" % (
+                        Name,
+                        Zt.KeyN
+                    ))
+                ZDict[ustr(Zt.ItemN) + u'Id'] = WAmount + 1
+            elif SfGenOper == 58:
+                if Zt.KeyN == 'preset':
+                    logging.warn('ignoring overridingRootKey in preset')
+                else:
+                    ZDict[ustr(Name)] = WAmount
+            elif SfGenOper == 57:
+                if Zt.KeyN == 'preset':
+                    logging.warn('ignoring exclusiveClass in preset')
+                else:
+                    ZDict[ustr(Name)] = WAmount
+            elif SfGenOper == 54:
+                if Zt.KeyN == 'preset':
+                    logging.warn('ignoring sampleModes in preset')
+                else:
+                    ZDict[ustr(Name)] = Def(
+                        Val(SfSampleModes, WAmount),
+                        '0_LoopNone'
+                    )
+            else:
+                Generators.append({
+                    u'comment': Name,
+                    u'hexAmount': "0x%x" % WAmount,
+                    u'oper': SfGenOper
+                })
+            if SfGenOper == Zt.Oper:
+                break
+            J = J + 1
+        if len(Generators) > 0:
+            ZDict[u'gens'] = {
+                u'gen': Generators
             }
-            if Zt.KeyN == 'preset':
-                IPDict[u'bank'] = LastWBank
-            ZList = []
-            for I in range(LastWBagNdx, WBagNdx):
-                Base = I * BagRecLen
-                J = WGenNdx = struct.unpack('<H', BagD[Base:Base + 2])[0]
-                ZDict = {}
-                Generators = []
-                while True:
-                    OBase = J * GenRecLen
-                    ABase = OBase + 2
-                    SfGenOper = struct.unpack('<H', GenD[OBase:OBase + 2])[0]
-                    (
-                        RangeBegin,
-                        RangeEnd
-                    ) = struct.unpack('2B', GenD[ABase:ABase + 2])
-                    ShAmount = struct.unpack('<h', GenD[ABase:ABase + 2])[0]
-                    WAmount = struct.unpack('<H', GenD[ABase:ABase + 2])[0]
-                    try:
-                        Name = SfGenNames[SfGenOper].split('_', 1)[1]
-                    except KeyError:
-                        Name = 'unknown'
-                    if ListHas([43, 44], SfGenOper) == True:
-                        ZDict[ustr(Name)] = {
-                            u'begin': RangeBegin,
-                            u'end': RangeEnd
-                        }
-                    elif ListHas([33, 34, 35, 36, 38], SfGenOper) == True:
-                        Dt = 0
-                        if ShAmount != SHMIN:
-                            Dt = pow(2.0, ShAmount / 1200.0)
-                        ZDict[ustr(Name)] = u'%0.04f' % (Dt)
-                    elif ListHas([37, 39, 40], SfGenOper) == True:
-                        ZDict[ustr(Name)] = ShAmount
-                    elif ListHas([53, 41], SfGenOper) == True:
-                        if SfGenOper != Zt.Oper:
-                            LogDie("%s operator found in %s context" % (
-                                Name,
-                                Zt.KeyN
-                            ))
-                        ZDict[ustr(Zt.ItemN) + u'Id'] = WAmount + 1
-                    elif SfGenOper == 58:
-                        if Zt.KeyN == 'preset':
-                            logging.warn('ignoring overridingRootKey in preset')
-                        else:
-                            ZDict[ustr(Name)] = WAmount
-                    elif SfGenOper == 57:
-                        if Zt.KeyN == 'preset':
-                            logging.warn('ignoring exclusiveClass in preset')
-                        else:
-                            ZDict[ustr(Name)] = WAmount
-                    elif SfGenOper == 54:
-                        if Zt.KeyN == 'preset':
-                            logging.warn('ignoring sampleModes in preset')
-                        else:
-                            ZDict[ustr(Name)] = Def(
-                                Val(SfSampleModes, WAmount),
-                                '0_LoopNone'
-                            )
-                    else:
-                        Generators.append({
-                            u'comment': Name,
-                            u'hexAmount': "0x%x" % WAmount,
-                            u'oper': SfGenOper
-                        })
-                    if SfGenOper == Zt.Oper:
-                        break
-                    J = J + 1
-                if len(Generators) > 0:
-                    ZDict[u'gens'] = {
-                        u'gen': Generators
-                    }
-                ZList.append(ZDict)
-                ZoneIndex = ZoneIndex + 1
-            IPDict[u'zones'][u'zone'] = ZList
-            List.append(IPDict)
-        Order = Order + 1
-    return List
+        ZList.append(ZDict)
+    IPDict[u'zones'][u'zone'] = ZList
+    return IPDict
 
-def SfZoneListInstrument(Tree):
-    return SfZoneList(Tree, SfZoneType('instrument'))
+# (name, preset, bank, bag index) of an inst or phdr record, preset and bank
+# are None for instruments
+def SfHdrFields(Zt, Record):
+    if Zt.KeyN == 'preset':
+        return Record[0:4]
+    return (Record[0], None, None, Record[1])
 
-def SfZoneListPreset(Tree):
-    return SfZoneList(Tree, SfZoneType('preset'))
+def SfZoneListInstrument(Riff):
+    return SfZoneList(Riff, SfZoneType('instrument'))
 
-def SfItems():
-    return [
-        SfTreeItem(0, 'RIFF', 'sfbk', None),
-        SfTreeItem(1, 'LIST', 'INFO', None),
-        SfTreeItem(1, 'LIST', 'sdta', None),
-        SfTreeItem(1, 'LIST', 'pdta', None),
-        SfTreeItem(2, 'ifil', None, None),
-        SfTreeItem(2, 'isng', None, None),
-        SfTreeItem(2, 'INAM', None, None),
-        SfTreeItem(2, 'irom', None, None),
-        SfTreeItem(2, 'iver', None, None),
-        SfTreeItem(2, 'ICRD', None, None),
-        SfTreeItem(2, 'IENG', None, None),
-        SfTreeItem(2, 'IPRD', None, None),
-        SfTreeItem(2, 'ICOP', None, None),
-        SfTreeItem(2, 'ICMT', None, None),
-        SfTreeItem(2, 'ISFT', None, None),
-        SfTreeItem(2, 'smpl', None, None),
-        SfTreeItem(2, 'sm24', None, None),
-        SfTreeItem(2, 'phdr', None, None),
-        SfTreeItem(2, 'pbag', None, None),
-        SfTreeItem(2, 'pmod', None, None),
-        SfTreeItem(2, 'pgen', None, None),
-        SfTreeItem(2, 'inst', None, None),
-        SfTreeItem(2, 'ibag', None, None),
-        SfTreeItem(2, 'imod', None, None),
-        SfTreeItem(2, 'igen', None, None),
-        SfTreeItem(2, 'shdr', None, None)
-    ]
+def SfZoneListPreset(Riff):
+    return SfZoneList(Riff, SfZoneType('preset'))
 
-def SfToXml(Src, Dst):
-    WtPrefix = os.path.splitext(Dst)[0]
-    InHandle = open(Src, 'rb')
-    OutHandle = open(Dst, 'wb')
-    Chunk = SfChunkReader(InHandle)
-    Tree = SfTree(SfItems(), SfContainers, None, OutHandle, WtPrefix)
-    Tree.Read(Chunk, 0)
-    Ifil = Tree.CkId('ifil', None, -1)
-    if Ifil != None:
-        IfilD = Ifil.Chunk.DataRead()
-        (
-            Major,
-            Minor
-        ) = struct.unpack('<2H', IfilD)
-    else:
-        Major = 2
-        Minor = 1
-    Dict = {
+# The manifest dict of a SoundFont. The wavetables are extracted right away,
+# the instruments and presets are generators decoding them one by one as the
+# writer gets to them.
+def SfRiffDict(Riff, Workers = None):
+    (
+        Major,
+        Minor
+    ) = Riff.Ifil()
+    return {
         u'wavetables': {
-            u'wavetable': SfWavetableList(Tree)
+            u'wavetable': SfWavetableList(Riff, Workers)
         },
         u'instruments': {
-            u'instrument': SfZoneListInstrument(Tree)
+            u'instrument': SfZoneListInstrument(Riff)
         },
         u'presets': {
-            u'preset': SfZoneListPreset(Tree)
+            u'preset': SfZoneListPreset(Riff)
         },
-        u'ISNG': Def(Tree.CkIdStr('isng', None, -1), u'pysf song'),
-        u'INAM': Def(Tree.CkIdStr('INAM', None, -1), u'pysf instruments'),
-        u'ICRD': Def(Tree.CkIdStr('ICRD', None, -1), ustr(DateAsciiGet())),
-        u'IPRD': Def(Tree.CkIdStr('IPRD', None, -1), u'SBAWE32'),
+        u'ISNG': Def(Riff.CkIdStr('isng'), u'pysf song'),
+        u'INAM': Def(Riff.CkIdStr('INAM'), u'pysf instruments'),
+        u'ICRD': Def(Riff.CkIdStr('ICRD'), ustr(DateAsciiGet())),
+        u'IPRD': Def(Riff.CkIdStr('IPRD'), u'SBAWE32'),
         u'IFIL': {
             u'major': Major,
             u'minor': Minor
         },
         u'ISFT': Def(
-            Tree.CkIdStr('ISFT', None, -1),
+            Riff.CkIdStr('ISFT'),
             u'pysf %d:pysf %d' % (PysfVersion, PysfVersion)
         )
-     }
-    OutHandle.write(DictToXmlStr({
-        u'sf2': Dict
-    }))
-    InHandle.close()
+    }
+
+@SfStage('SfToXml')
+def SfToXml(Src, Dst, Workers = None):
+    WtPrefix = os.path.splitext(Dst)[0]
+    Riff = SfRiff(Src, WtPrefix)
+    SfBytesRead(os.path.getsize(Src))
+    OutHandle = open(Dst, 'w')
+    DictToXmlFile({
+        u'sf2': SfRiffDict(Riff, Workers)
+    }, OutHandle)
+    Riff.Close()
+    OutHandle.close()
+
+@SfStage('SfToBin')
+def SfToBin(Src, Dst, Workers = None):
+    WtPrefix = os.path.splitext(Dst)[0]
+    Riff = SfRiff(Src, WtPrefix)
+    SfBytesRead(os.path.getsize(Src))
+    OutHandle = open(Dst, 'wb')
+    Writer = SfBinWriter(OutHandle)
+    for (
+        Tag,
+        Value
+    ) in DictSf2Items(SfRiffDict(Riff, Workers)):
+        Writer.Item(Tag, Value)
+    SfBytesWritten(Writer.Close())
+    Riff.Close()
     OutHandle.close()
 
 def SfIfil(Dict):
@@ -867,24 +1442,25 @@ def SfInfo(Dict):
     ]
     Ieng = SfStr(Val(Dict, u'IENG'))
     if Ieng != None:
-        List[1].append('IENG', Ieng)
-    map(List[1].append, [
+        List[1].extend(['IENG', Ieng])
+    List[1].extend([
         'IPRD', SfStr(Def(Val(Dict, u'IPRD'), 'SBAWE32')),
         'ISFT', SfStr(Def(Val(Dict, u'ISFT'), 'SFEDT v1.28'))
     ])
     return List
 
-def StereoSampleCheck(Wavetables, Id, Channel, WSampleLink):
+# WavetablesById: id -> dict with the link of that wavetable, if it has one
+def StereoSampleCheck(WavetablesById, Id, Channel, WSampleLink):
     if Channel == 'right':
        RightId = Id
        LeftId = WSampleLink
     else:
        RightId = WSampleLink
        LeftId = Id
-    Left = LdFind(Wavetables, u'id', LeftId)
+    Left = WavetablesById.get(LeftId)
     if Left == None:
         LogDie("Wavetable %d: Can't find left channel" % (Id))
-    Right = LdFind(Wavetables, u'id', RightId)
+    Right = WavetablesById.get(RightId)
     if Right == None:
         LogDie("Wavetable %d: Can't find right channel" % (Id))
     if Left[u'link'] != RightId:
@@ -892,20 +1468,150 @@ def StereoSampleCheck(Wavetables, Id, Channel, WSampleLink):
     if Right[u'link'] != LeftId:
         LogDie("Wavetable %d: Right channel not linked to Left" % (Id))
 
-def SfSdtaShdr(Dict):
-    ShdrFmtStr = '<20sIIIIIBbHH'
-    ShdrD = bytearray()
-    SmplD = tempfile.TemporaryFile()
-    Sm24D = tempfile.TemporaryFile()
-    Id = -1
-    Order = 0
-    (
-        Major,
-        Minor
-    ) = Def(SfIfil(Dict), (2, 1))
+# Plans the sdta LIST from the wavetable headers alone: where every sample
+# goes in smpl/sm24 and how it has to be transformed. SfSdtaWrite then copies
+# each sample straight to its final position in the output file.
+# Items with Copy = (smpl position, sm24 position, samples) are copied from
+# CopyHandle, a previous build, instead of being read from their file.
+class SfSdtaLayout:
+    Items = None
+    SmplSize = 0
+    Sm24Size = None
+    CopyHandle = None
+
+    def __init__(self):
+        self.Items = []
+        self.SmplSize = 0
+        self.Sm24Size = None
+        self.CopyHandle = None
+
+    def ItemAdd(self, FileName, Format, Byteswap, Channel, SampWidth, Frames, Samples, Copy = None):
+        self.Items.append((
+            FileName,
+            Format,
+            Byteswap,
+            Channel,
+            SampWidth,
+            Frames,
+            self.SmplSize,
+            Def(self.Sm24Size, 0),
+            Copy
+        ))
+        self.SmplSize = self.SmplSize + (Samples + 46) * 2
+        if SampWidth == 3:
+            self.Sm24Size = Def(self.Sm24Size, 0) + Samples + 46
+
+    def ListSize(self):
+        Retval = 12 + 8 + self.SmplSize
+        if self.Sm24Size != None:
+            Retval = Retval + 8 + self.Sm24Size + self.Sm24Size % 2
+        return Retval
+
+# file-like writer that keeps its own position in a shared handle
+class SfPosWriter:
+    Handle = None
+    Pos = 0
+
+    def __init__(self, Handle, Pos):
+        self.Handle = Handle
+        self.Pos = Pos
+
+    def write(self, Data):
+        self.Handle.seek(self.Pos)
+        self.Handle.write(Data)
+        self.Pos = self.Pos + len(Data)
+
+# Compiles the wavetables one at a time into their shdr records and the
+# sdta layout. The checks that need the other wavetables or ifil, which may
+# come later in a manifest, wait for Finish.
+class SfShdrBuilder:
+    ShdrD = None
+    Layout = None
+    Count = 0
     GlobalSampWidth = -1
-    Wavetables = Dict[u'wavetables'][u'wavetable']
-    for Wavetable in Wavetables:
+    MixedWidth = None
+    Wide = None
+    WavetablesById = None
+    Stereo = None
+    Old = None
+    OldShdrs = None
+    Changed = None
+
+    # with Old, the SfRiff of a previous build, the sample data of every
+    # wavetable not in Changed (ids) is copied from there when it still fits
+    def __init__(self, Old = None, Changed = ()):
+        self.ShdrD = bytearray()
+        self.Layout = SfSdtaLayout()
+        self.Count = 0
+        self.GlobalSampWidth = -1
+        # (order, sample width) of the first wavetable not as wide as the
+        # first one
+        self.MixedWidth = None
+        # order of the first 24 bit wavetable
+        self.Wide = None
+        # just the links, for StereoSampleCheck
+        self.WavetablesById = {}
+        # (id, channel, link) of every stereo wavetable
+        self.Stereo = []
+        self.Old = Old
+        self.Changed = frozenset(Changed)
+        # (start, end, sample type, name, sample rate) of the wavetables of Old
+        self.OldShdrs = []
+        if Old != None:
+            Shdr = Old.CkId('shdr')
+            if Shdr == None:
+                LogDie('no wavetable headers in the old SoundFont')
+            for Record in SfRecords(Shdr, SfShdrCodec):
+                self.OldShdrs.append((
+                    Record[1],
+                    Record[2],
+                    Record[9],
+                    SfStrDecode(Record[0]),
+                    Record[5]
+                ))
+            # the terminal EOS header
+            self.OldShdrs = self.OldShdrs[:-1]
+            self.Layout.CopyHandle = Old.Handle
+
+    # (smpl position, sm24 position, samples) of the data of wavetable Id in
+    # the old SoundFont, None when it has to be read from its file. Old data
+    # is matched by position, so the name and rate must match as well: when
+    # ids shift, another wavetable of the same length must not be reused.
+    def OldData(self, Id, SfSampleType, Frames, SampWidth, Samples, Name, Rate):
+        if self.Old == None or        \
+            Id in self.Changed or     \
+            Id > len(self.OldShdrs)   \
+        :
+            return None
+        (
+            Start,
+            End,
+            OldSfSampleType,
+            OldName,
+            OldRate
+        ) = self.OldShdrs[Id - 1]
+        Smpl = self.Old.CkId('smpl')
+        if End - Start != Frames or              \
+            OldSfSampleType != SfSampleType or   \
+            OldName != SfStrDecode(Name) or      \
+            OldRate != Rate or                   \
+            Smpl == None or                      \
+            (Start + Samples) * 2 > Smpl.Size    \
+        :
+            return None
+        Sm24Pos = None
+        if SampWidth == 3:
+            Sm24 = self.Old.CkId('sm24')
+            if Sm24 == None or                \
+                Start + Samples > Sm24.Size   \
+            :
+                return None
+            Sm24Pos = Sm24.Offset + Start
+        return (Smpl.Offset + Start * 2, Sm24Pos, Samples)
+
+    @SfStage('SfSdtaShdr')
+    def Add(self, Wavetable):
+        Order = self.Count
         Id = Wavetable[u'id']
         if Id != Order + 1:
             LogDie("Wavetable %d: id=%d, expected %d" % (
@@ -918,7 +1624,9 @@ def SfSdtaShdr(Dict):
         if Ext == 'wav':
             Aud = wave.open(str(FileName), 'rb')
             DataOrder = 'little'
-        elif Ext == 'aif':
+        elif Ext == 'aif' and \
+            aifc != None      \
+        :
             Aud = aifc.open(str(FileName), 'rb')
             DataOrder = 'big'
         else:
@@ -958,16 +1666,22 @@ def SfSdtaShdr(Dict):
         ByOriginalPitch = Def(Val(Wavetable, u'pitch'), 60)
         SfSampleType = 1
         WSampleLink = 0
+        if u'link' in Wavetable:
+            self.WavetablesById[Id] = {
+                u'link': Wavetable[u'link']
+            }
+        else:
+            self.WavetablesById[Id] = {}
         try:
             Channel = Wavetable[u'channel']
             if Channel == 'right':
                 SfSampleType = 2
                 WSampleLink = Wavetable[u'link'] - 1
-                StereoSampleCheck(Wavetables, Id, Channel, WSampleLink + 1)
+                self.Stereo.append((Id, Channel, WSampleLink + 1))
             elif Channel == 'left':
                 SfSampleType = 4
                 WSampleLink = Wavetable[u'link'] - 1
-                StereoSampleCheck(Wavetables, Id, Channel, WSampleLink + 1)
+                self.Stereo.append((Id, Channel, WSampleLink + 1))
         except KeyError:
             pass
         if ByOriginalPitch > 127:
@@ -983,48 +1697,58 @@ def SfSdtaShdr(Dict):
             elif SfSampleType == 4:
                 # left, filter out right
                 AudChannel = 0
-        WtStart = SmplD.tell() / 2
+        WtStart = self.Layout.SmplSize / 2
         WtEnd = WtStart + Aud.getnframes()
         WtLoopstart = WtLoopstart + WtStart
         WtLoopend = WtLoopend + WtStart
         WtRate = Aud.getframerate()
         SmplCksize = (WtEnd + 46) * 2
-        if Major == 2 and \
-            Minor >= 4    \
+        # the sample width checks depend on ifil, they are done by Finish
+        if self.GlobalSampWidth == -1:
+            self.GlobalSampWidth = Aud.getsampwidth()
+        if self.GlobalSampWidth != Aud.getsampwidth() and \
+            self.MixedWidth == None                      \
+        :
+            self.MixedWidth = (Order + 1, Aud.getsampwidth())
+        if Aud.getsampwidth() == 3 and \
+            self.Wide == None          \
+        :
+            self.Wide = Order + 1
+        if Aud.getsampwidth() != 2 and \
+            Aud.getsampwidth() != 3    \
         :
-            if GlobalSampWidth == -1:
-                GlobalSampWidth = Aud.getsampwidth()
-            if GlobalSampWidth != Aud.getsampwidth():
-                LogDie("Wavetable %d: %d bit, other are %d bit" % (
-                    Order + 1,
-                    Aud.getsampwidth() * 8,
-                    GlobalSampWidth * 8
-                ))
-        else:
-            if Aud.getsampwidth() == 3:
-                LogDie("Wavetable %d: 24 bit, but ifil 2.1" % (Order + 1))
-        if Aud.getsampwidth() == 2:
-            DataCopy(Aud, SmplD, 2, Aud.getnframes(), Byteswap, AudChannel)
-        elif Aud.getsampwidth() == 3:
-            DataCopy(Aud, Sm24D, 3, Aud.getnframes(), Byteswap, AudChannel,
-                'part24')
-            Sm24D.write(struct.pack('46s', '')) # 46 sample Pad
-            Aud.rewind()
-            DataCopy(Aud, SmplD, 3, Aud.getnframes(), Byteswap, AudChannel,
-                'part16')
-        else:
             LogDie("Wavetable %d: can't use %d bit sample width" % (
                 Order + 1,
                 Aud.getsampwidth() * 8
             ))
-        SmplD.write(struct.pack('92s', bytes('', 'utf-8'))) # 46 sample Pad
+        Samples = Aud.getnframes()
+        if AudChannel == -1:
+            Samples = Samples * Aud.getnchannels()
+        self.Layout.ItemAdd(
+            FileName,
+            Ext,
+            Byteswap,
+            AudChannel,
+            Aud.getsampwidth(),
+            Aud.getnframes(),
+            Samples,
+            self.OldData(
+                Id,
+                SfSampleType,
+                Aud.getnframes(),
+                Aud.getsampwidth(),
+                Samples,
+                WtName,
+                WtRate
+            )
+        )
         Aud.close()
         WtStart = int(WtStart)
         WtEnd = int(WtEnd)
         WtLoopstart = int(WtLoopstart)
         WtLoopend = int(WtLoopend)
-        ShdrD.extend(struct.pack(
-            ShdrFmtStr,
+        self.ShdrD.extend(struct.pack(
+            SfShdrFmtStr,
             WtName,
             WtStart,
             WtEnd,
@@ -1036,40 +1760,156 @@ def SfSdtaShdr(Dict):
             WSampleLink,
             SfSampleType
         ))
-        Order = Order + 1
-    WtName = bytes('EOS',"utf-8")
-    ShdrD.extend(struct.pack(
-        ShdrFmtStr,
-        WtName,
-        0,
-        0,
-        0,
-        0,
-        0,
-        0,
-        0,
-        0,
-        0
-    ))
-    Shdr = ['shdr', ShdrD]
-    if Major == 2 and \
-        Minor >= 4    \
+        self.Count = self.Count + 1
+
+    def Finish(self, Major, Minor):
+        for (
+            Id,
+            Channel,
+            Link
+        ) in self.Stereo:
+            try:
+                StereoSampleCheck(self.WavetablesById, Id, Channel, Link)
+            except KeyError:
+                pass
+        if Major == 2 and \
+            Minor >= 4    \
+        :
+            self.Layout.Sm24Size = Def(self.Layout.Sm24Size, 0)
+            if self.MixedWidth != None:
+                LogDie("Wavetable %d: %d bit, other are %d bit" % (
+                    self.MixedWidth[0],
+                    self.MixedWidth[1] * 8,
+                    self.GlobalSampWidth * 8
+                ))
+        else:
+            if self.Wide != None:
+                LogDie("Wavetable %d: 24 bit, but ifil 2.1" % (self.Wide))
+        ShdrD = self.ShdrD
+        WtName = bytes('EOS',"utf-8")
+        ShdrD.extend(struct.pack(
+            SfShdrFmtStr,
+            WtName,
+            0,
+            0,
+            0,
+            0,
+            0,
+            0,
+            0,
+            0,
+            0
+        ))
+        Shdr = ['shdr', ShdrD]
+        return (self.Layout, Shdr)
+
+@SfStage('SfSdtaWrite')
+def SfSdtaWrite(Layout, OutHandle):
+    ListPos = OutHandle.tell()
+    OutHandle.write(struct.pack('<4sI4s', b'LIST', Layout.ListSize() - 8, b'sdta'))
+    OutHandle.write(struct.pack('<4sI', b'smpl', Layout.SmplSize))
+    SmplPos = OutHandle.tell()
+    Sm24Pos = SmplPos + Layout.SmplSize + 8
+    if Layout.Sm24Size != None:
+        OutHandle.seek(Sm24Pos - 8)
+        OutHandle.write(struct.pack(
+            '<4sI',
+            b'sm24',
+            Layout.Sm24Size + Layout.Sm24Size % 2
+        ))
+    for (
+        FileName,
+        Format,
+        Byteswap,
+        AudChannel,
+        SampWidth,
+        Frames,
+        SmplOffset,
+        Sm24Offset,
+        Copy
+    ) in Layout.Items:
+        if Copy != None:
+            SfCopyRange(
+                Layout.CopyHandle,
+                Copy[0],
+                OutHandle,
+                SmplPos + SmplOffset,
+                Copy[2] * 2
+            )
+            Smpl = SfPosWriter(OutHandle, SmplPos + SmplOffset + Copy[2] * 2)
+            Smpl.write(bytes(92)) # 46 sample Pad
+            if SampWidth == 3:
+                SfCopyRange(
+                    Layout.CopyHandle,
+                    Copy[1],
+                    OutHandle,
+                    Sm24Pos + Sm24Offset,
+                    Copy[2]
+                )
+                Sm24 = SfPosWriter(OutHandle, Sm24Pos + Sm24Offset + Copy[2])
+                Sm24.write(bytes(46)) # 46 sample Pad
+            continue
+        Aud = AudOpen(str(FileName), 'rb', Format)
+        Smpl = SfPosWriter(OutHandle, SmplPos + SmplOffset)
+        if SampWidth == 3:
+            Sm24 = SfPosWriter(OutHandle, Sm24Pos + Sm24Offset)
+            DataCopy(Aud, (Smpl, Sm24), 3, Frames, Byteswap, AudChannel)
+            Sm24.write(bytes(46)) # 46 sample Pad
+        else:
+            DataCopy(Aud, Smpl, 2, Frames, Byteswap, AudChannel)
+        Smpl.write(bytes(92)) # 46 sample Pad
+        Aud.close()
+    OutHandle.seek(ListPos + Layout.ListSize())
+    if Layout.Sm24Size != None and \
+        Layout.Sm24Size % 2 > 0    \
     :
-        Sdta = [
-            ['LIST', 'sdta'],
-            [
-                'smpl', SmplD,
-                'sm24', Sm24D
-            ]
-        ]
-    else:
-        Sdta = [
-            ['LIST', 'sdta'],
-            [
-                'smpl', SmplD
-            ]
-        ]
-    return (Sdta, Shdr)
+        OutHandle.seek(-1, 1)
+        OutHandle.write(b'\0')
+    SfBytesWritten(Layout.ListSize())
+
+# Copies Size bytes at SrcPos of InHandle to DstPos of OutHandle inside the
+# kernel where the OS can (copy_file_range, then sendfile), through a buffer
+# otherwise. The position of OutHandle is left undefined.
+def SfCopyRange(InHandle, SrcPos, OutHandle, DstPos, Size):
+    OutHandle.flush()
+    InFd = InHandle.fileno()
+    OutFd = OutHandle.fileno()
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while Size > 0:
+                Done = os.copy_file_range(InFd, OutFd, Size, SrcPos, DstPos)
+                if Done == 0:
+                    break
+                SrcPos = SrcPos + Done
+                DstPos = DstPos + Done
+                Size = Size - Done
+        except OSError:
+            # e.g. not supported between these file systems
+            pass
+    if Size > 0 and \
+        hasattr(os, 'sendfile') \
+    :
+        try:
+            os.lseek(OutFd, DstPos, os.SEEK_SET)
+            while Size > 0:
+                Done = os.sendfile(OutFd, InFd, SrcPos, Size)
+                if Done == 0:
+                    break
+                SrcPos = SrcPos + Done
+                DstPos = DstPos + Done
+                Size = Size - Done
+        except OSError:
+            pass
+    while Size > 0:
+        InHandle.seek(SrcPos)
+        Data = InHandle.read(min(Size, 1024 * 1024))
+        if len(Data) == 0:
+            LogDie('sample data of the old SoundFont truncated')
+        OutHandle.seek(DstPos)
+        OutHandle.write(Data)
+        SrcPos = SrcPos + len(Data)
+        DstPos = DstPos + len(Data)
+        Size = Size - len(Data)
 
 def SfRange(Item, Key, Min, Max, DefaultVal, Msg, Warn):
     try:
@@ -1097,47 +1937,65 @@ def SfLog(Item, Key, DefaultVal):
         Value = math.floor(1200.0 * (math.log(Value) / math.log(2)))
     return Value
 
-def SfZone(Dict, Zt):
-    Order = 0
-    LastNBag = 0
-    Loopstart = 0
-    Loopend = 0
-    IopsCount = 0
-    ItemMax = len(Dict[Zt.ItemN + u's'][Zt.ItemN])
+# Compiles instruments or presets one at a time into their pdta chunks. The
+# zones refer to wavetables or instruments that may come later in a
+# manifest, so the references are only range checked by Finish.
+class SfZoneBuilder:
+    Zt = None
     GenC = 0
     ModC = 0
     BagC = 0
     HdrC = 0
-    GenD = bytearray()
-    ModD = ''
-    BagD = bytearray()
-    HdrD = bytearray()
+    GenD = None
+    ModD = None
+    BagD = None
+    HdrD = None
+    LastNBag = 0
+    RefMin = None
+    RefMax = None
+
+    def __init__(self, Zt):
+        self.Zt = Zt
+        self.GenC = 0
+        self.ModC = 0
+        self.BagC = 0
+        self.HdrC = 0
+        self.GenD = bytearray()
+        self.ModD = ''
+        self.BagD = bytearray()
+        self.HdrD = bytearray()
+        self.LastNBag = 0
+        # (zone, item index) of the lowest and highest reference
+        self.RefMin = None
+        self.RefMax = None
 
-    for InPr in Dict[Zt.KeyN + u's'][Zt.KeyN]:
-        logging.info("reading %s %d" % (Zt.KeyN, Order + 1))
+    @SfStage('SfZone')
+    def Add(self, InPr):
+        Zt = self.Zt
+        Order = self.HdrC
+        logging.info("reading %s %d", Zt.KeyN, Order + 1)
         Name = SfStr(Def(Val(InPr, u'name'), ''), 20)
         if Zt.KeyN == 'preset':
             WBank = Def(Val(InPr, u'bank'), 0)
         ZoneIndex = 0
         if len(InPr[u'zones'][u'zone']) == 0:
-            GenD.extend(struct.pack('<HH', 60, 0))
-            BagD.extend(struct.pack('<HH', GenC, ModC))
-            GenC = GenC + 1
-            ModC = ModC + 1
+            self.GenD.extend(struct.pack('<HH', 60, 0))
+            self.BagD.extend(struct.pack('<HH', self.GenC, self.ModC))
+            self.GenC = self.GenC + 1
+            self.ModC = self.ModC + 1
         for Zone in InPr[u'zones'][u'zone']:
             Wstr = "%s %d zone %d" % (Zt.KeyN, Order + 1, ZoneIndex + 1)
-            logging.info("reading %s" % (Wstr))
+            logging.info("reading %s", Wstr)
             IopsCount = 1
             ItemRef = Zone[Zt.ItemN + u'Id'] - 1
-            if ItemRef < 0 or     \
-                ItemRef > ItemMax \
+            if self.RefMin == None or   \
+                ItemRef < self.RefMin[1] \
             :
-                LogDie("%s: invalid %s index %d (range 0,%d)" % (
-                    Wstr,
-                    Zt.ItemN,
-                    ItemRef,
-                    ItemMax
-                ))
+                self.RefMin = (Wstr, ItemRef)
+            if self.RefMax == None or   \
+                ItemRef > self.RefMax[1] \
+            :
+                self.RefMax = (Wstr, ItemRef)
             (
                 KeyRangeBegin,
                 KeyRangeEnd
@@ -1146,7 +2004,7 @@ def SfZone(Dict, Zt):
                 KeyRangeEnd > -1      \
             :
                 IopsCount = IopsCount + 1
-                GenD.extend(struct.pack(
+                self.GenD.extend(struct.pack(
                     '<HBB',
                     43,
                     KeyRangeBegin,
@@ -1160,7 +2018,7 @@ def SfZone(Dict, Zt):
                 VelRangeEnd > -1      \
             :
                 IopsCount = IopsCount + 1
-                GenD.extend(struct.pack(
+                self.GenD.extend(struct.pack(
                     '<HBB',
                     44,
                     VelRangeBegin,
@@ -1169,23 +2027,12 @@ def SfZone(Dict, Zt):
             OverridingRootKey = Def(Val(Zone, u'overridingRootKey'), -1)
             if OverridingRootKey > -1:
                 IopsCount = IopsCount + 1
-                GenD.extend(struct.pack('<HH', 58, OverridingRootKey))
+                self.GenD.extend(struct.pack('<HH', 58, OverridingRootKey))
             ExclusiveClass = Def(Val(Zone, u'exclusiveClass'), -1)
             if ExclusiveClass > -1:
                 IopsCount = IopsCount + 1
-                GenD.extend(struct.pack('<HH', 57, ExclusiveClass))
+                self.GenD.extend(struct.pack('<HH', 57, ExclusiveClass))
             if Zt.KeyN == 'instrument':
-                try:
-                    Wavetable = LdFind(
-                        Dict[u'wavetables'][u'wavetable'],
-                        u'id',
-                        ItemRef + 1
-                    )
-                    Loopstart = Wavetable[u'loop'][u'begin']
-                    Loopend = Wavetable[u'loop'][u'end']
-                except (IndexError, KeyError):
-                    Loopstart = 0
-                    Loopend = 0
                 SampleModesStr = Def(Val(Zone, u'sampleModes'), "0_LoopNone")
                 if SampleModesStr == "0_LoopNone":
                      SampleModes = 0
@@ -1203,80 +2050,98 @@ def SfZone(Dict, Zt):
                     ))
                     SampleModes = 0
                 IopsCount = IopsCount + 1
-                GenD.extend(struct.pack('<Hh', 54, SampleModes))
+                self.GenD.extend(struct.pack('<Hh', 54, SampleModes))
             EnvDelay = SfLog(Zone, u'delayVolEnv', SHOOBVAL)
             if EnvDelay > SHOOBVAL:
                 IopsCount = IopsCount + 1
-                GenD.extend(struct.pack('<Hh', 33, EnvDelay))
+                self.GenD.extend(struct.pack('<Hh', 33, EnvDelay))
             EnvAttack = SfLog(Zone, u'attackVolEnv', SHOOBVAL)
             if EnvAttack > SHOOBVAL:
                 IopsCount = IopsCount + 1
-                GenD.extend(struct.pack('<Hh', 34, EnvAttack))
+                self.GenD.extend(struct.pack('<Hh', 34, EnvAttack))
             EnvHold = SfLog(Zone, u'holdVolEnv', SHOOBVAL)
             if EnvHold > SHOOBVAL:
                 IopsCount = IopsCount + 1
-                GenD.extend(struct.pack('<Hh', 35, EnvHold))
+                self.GenD.extend(struct.pack('<Hh', 35, EnvHold))
             EnvDecay = SfLog(Zone, u'decayVolEnv', SHOOBVAL)
             if EnvDecay > SHOOBVAL:
                 IopsCount = IopsCount + 1
-                GenD.extend(struct.pack('<Hh', 36, EnvDecay))
+                self.GenD.extend(struct.pack('<Hh', 36, EnvDecay))
             EnvSustain = Def(Val(Zone, u'sustainVolEnv'), SHOOBVAL)
             if EnvSustain > SHOOBVAL:
                 IopsCount = IopsCount + 1
-                GenD.extend(struct.pack('<Hh', 37, EnvSustain))
+                self.GenD.extend(struct.pack('<Hh', 37, EnvSustain))
             EnvRelease = SfLog(Zone, u'releaseVolEnv', SHOOBVAL)
             if EnvRelease > SHOOBVAL:
                 IopsCount = IopsCount + 1
-                GenD.extend(struct.pack('<Hh', 38, EnvRelease))
+                self.GenD.extend(struct.pack('<Hh', 38, EnvRelease))
             KtveHold = Def(Val(Zone, u'keynumToVolEnvHold'), SHOOBVAL)
             if KtveHold > SHOOBVAL:
                 IopsCount = IopsCount + 1
-                GenD.extend(struct.pack('<Hh', 39, KtveHold))
+                self.GenD.extend(struct.pack('<Hh', 39, KtveHold))
             KtveDecay = Def(Val(Zone, u'keynumToVolEnvDecay'), SHOOBVAL)
             if KtveDecay > SHOOBVAL:
                 IopsCount = IopsCount + 1
-                GenD.extend(struct.pack('<Hh', 40, KtveDecay))
+                self.GenD.extend(struct.pack('<Hh', 40, KtveDecay))
             try:
                 for Generator in Zone[u'gens'][u'gen']:
                     IopsCount = IopsCount + 1
-                    GenD.extend(struct.pack(
+                    self.GenD.extend(struct.pack(
                         '<HH',
                         Generator[u'oper'],
                         Generator[u'hexAmount']
                     ))
             except KeyError:
                 pass
-            GenD.extend(struct.pack('<HH', Zt.Oper, ItemRef))
-            BagD.extend(struct.pack('<HH', GenC, ModC))
-            GenC = GenC + IopsCount
-            BagC = BagC + 1
+            self.GenD.extend(struct.pack('<HH', Zt.Oper, ItemRef))
+            self.BagD.extend(struct.pack('<HH', self.GenC, self.ModC))
+            self.GenC = self.GenC + IopsCount
+            self.BagC = self.BagC + 1
             ZoneIndex = ZoneIndex + 1
         if Zt.KeyN == 'instrument':
-            HdrD.extend(struct.pack('<20sH', Name, LastNBag))
+            self.HdrD.extend(struct.pack('<20sH', Name, self.LastNBag))
         elif Zt.KeyN == 'preset':
-            WPreset = HdrC
-            HdrD.extend(struct.pack(
+            WPreset = self.HdrC
+            self.HdrD.extend(struct.pack(
                 '<20sHHHIII',
                 Name,
                 WPreset,
                 WBank,
-                LastNBag,
+                self.LastNBag,
                 0,
                 0,
                 0
             ))
-        HdrC = HdrC + 1
-        LastNBag = BagC
-        Order = Order + 1
-    return (GenD, ModD, BagD, HdrD, GenC, ModC, BagC, HdrC)
-
-def SfZoneInstrument(Dict):
-    return SfZone(Dict, SfZoneType('instrument'))
+        self.HdrC = self.HdrC + 1
+        self.LastNBag = self.BagC
 
-def SfZonePreset(Dict):
-    return SfZone(Dict, SfZoneType('preset'))
+    def Finish(self, ItemMax):
+        for Ref in (self.RefMin, self.RefMax):
+            if Ref == None:
+                continue
+            if Ref[1] < 0 or      \
+                Ref[1] >= ItemMax \
+            :
+                LogDie("%s: invalid %s index %d (range 0,%d)" % (
+                    Ref[0],
+                    self.Zt.ItemN,
+                    Ref[1],
+                    ItemMax - 1
+                ))
+        return (
+            self.GenD,
+            self.ModD,
+            self.BagD,
+            self.HdrD,
+            self.GenC,
+            self.ModC,
+            self.BagC,
+            self.HdrC
+        )
 
-def SfPdta(Dict, Shdr):
+# Instruments and Presets are the results of SfZoneBuilder.Finish
+@SfStage('SfPdta')
+def SfPdta(Instruments, Presets, Shdr):
     (
         IgenD,
         ImodD,
@@ -1286,7 +2151,7 @@ def SfPdta(Dict, Shdr):
         ImodC,
         IbagC,
         InstC
-    ) = SfZoneInstrument(Dict)
+    ) = Instruments
     (
         PgenD, 
         PmodD,
@@ -1296,7 +2161,7 @@ def SfPdta(Dict, Shdr):
         PmodC,
         PbagC,
         PhdrC
-    ) = SfZonePreset(Dict)
+    ) = Presets
     ImodD = bytearray()
     PmodD = bytearray()
     InstD.extend(struct.pack('<20sH', bytes('EOI',"utf-8"), IbagC))
@@ -1324,28 +2189,204 @@ def SfPdta(Dict, Shdr):
     ]
     return Pdta
 
+@SfStage('XmlToSf')
 def XmlToSf(Src, Dst):
-    OutHandle = open(Dst, 'wb')
-    try:
-        Dict = XmlFileToDict(Src)[u'sf:pysf'][u'sf2']
-    except KeyError:
-        LogDie('Invalid input format.')
-    Info = SfInfo(Dict)
-    [Sdta, Shdr] = SfSdtaShdr(Dict)
-    Pdta = SfPdta(Dict, Shdr)
-    List = [
-        ['RIFF', 'sfbk'],
-        [
-            Info[0],
-            Info[1],
-            Sdta[0],
-            Sdta[1],
-            Pdta[0],
-            Pdta[1]
-        ]
+    SfItemsToSf(XmlSf2Items(Src), Dst)
+
+@SfStage('BinToSf')
+def BinToSf(Src, Dst):
+    SfItemsToSf(BinSf2Items(Src), Dst)
+
+# Rebuilds Old from a manifest (XML or binary) where only the wavetables with
+# an id in Changed have new audio. Their files are read, the data of every
+# other wavetable is copied from Old inside the kernel; the wavetable headers
+# are still read from the files, and a wavetable whose length, channel, name
+# or rate no longer matches Old is read as well. Wavetables past the end of
+# Old are new.
+@SfStage('SfUpdate')
+def SfUpdate(Old, Changed, Src, Dst):
+    if os.path.exists(Dst) and         \
+        os.path.samefile(Old, Dst)     \
+    :
+        LogDie('the output must not be the old SoundFont')
+    Riff = SfRiff(Old)
+    InHandle = open(Src, 'rb')
+    Magic = InHandle.read(len(SfBinMagic))
+    InHandle.close()
+    if Magic == SfBinMagic:
+        Items = BinSf2Items(Src)
+    else:
+        Items = XmlSf2Items(Src)
+    SfItemsToSf(Items, Dst, Riff, Changed)
+    Riff.Close()
+
+# "3,7" -> [3, 7], "-" for none
+def SfIdList(Str):
+    Retval = []
+    for Item in Str.split(','):
+        Item = Item.strip()
+        if Item == '-' or \
+            Item == ''    \
+        :
+            continue
+        try:
+            Retval.append(int(Item))
+        except ValueError:
+            LogDie("%s: not a wavetable id" % (Item))
+    return Retval
+
+# Headers of the wavetables as (id, name, start, end, loop start, loop end,
+# sample rate, pitch, pitch correction, link, sample type) tuples, positions
+# in sample points from the start of smpl. Only shdr is read.
+def SfWavetableHeaders(Riff):
+    return [
+        (Order + 1, SfStrDecode(Record[0])) + tuple(Record[1:])
+        for Order, Record in enumerate(SfShdrRecords(Riff))
     ]
+
+# The header of the wavetable with id Key when Key is a number in range,
+# otherwise of the first wavetable named Key.
+def SfWavetableFind(Riff, Key):
+    Key = ustr(Key)
+    Headers = SfWavetableHeaders(Riff)
+    if Key.isdigit() and            \
+        1 <= int(Key) <= len(Headers) \
+    :
+        return Headers[int(Key) - 1]
+    for Header in Headers:
+        if Key == Header[1]:
+            return Header
+    LogDie("%s: no such wavetable" % (Key))
+
+# The smpl view and the sm24 view (or None) of a wavetable, no data copied.
+def SfWavetableData(Riff, Header):
+    (
+        Smpl,
+        Sm24
+    ) = SfSampleChunks(Riff)
+    Start = Header[2]
+    End = Header[3]
+    if Start > End or \
+        End * 2 > Smpl.Size \
+    :
+        LogDie("wavetable %d, sample range %d-%d out of bounds" % (
+            Header[0],
+            Start,
+            End
+        ))
+    if Sm24 == None:
+        Sm24D = None
+    else:
+        Sm24D = Sm24.Data[Start:End]
+    return (Smpl.Data[Start * 2:End * 2], Sm24D)
+
+# The sample points of a wavetable as a numpy array. For 16 bit data it is an
+# int16 view straight over the mapped smpl chunk, valid until Riff is closed;
+# with sm24 data the 24 bit values are joined into a new int32 array.
+def SfWavetableArray(Riff, Key):
+    if NumpyLoad() == None:
+        LogDie('numpy is not installed')
+    (
+        SmplD,
+        Sm24D
+    ) = SfWavetableData(Riff, SfWavetableFind(Riff, Key))
+    Retval = numpy.frombuffer(SmplD, '<i2')
+    if Sm24D != None:
+        Retval = Retval.astype(numpy.int32) * 256 + \
+            numpy.frombuffer(Sm24D, numpy.uint8)
+    return Retval
+
+# Writes one wavetable of Src to the WAV file Dst without unpacking the rest:
+# the chunk index and shdr are read, then only its range of smpl/sm24.
+@SfStage('SfWavetableExtract')
+def SfWavetableExtract(Src, Key, Dst):
+    Riff = SfRiff(Src)
+    Header = SfWavetableFind(Riff, Key)
+    (
+        SmplD,
+        Sm24D
+    ) = SfWavetableData(Riff, Header)
+    SfBytesRead(len(SmplD) + len(Def(Sm24D, b'')))
+    SfBytesWritten(SfWavetableWrite((
+        Dst,
+        Header[6],
+        SmplD,
+        Sm24D,
+        Header[3] - Header[2]
+    )))
+    del SmplD, Sm24D
+    Riff.Close()
+
+# Prints id, name, length in sample points, sample rate and type of every
+# wavetable of Src.
+def SfWavetablePrint(Src):
+    Riff = SfRiff(Src)
+    for Header in SfWavetableHeaders(Riff):
+        print("%d\t%s\t%d\t%d\t%s" % (
+            Header[0],
+            Header[1],
+            Header[3] - Header[2],
+            Header[6],
+            Def(Val(SfStNames, Header[10]), Header[10])
+        ))
+    Riff.Close()
+
+@SfStage('ListToBytes')
+def ListToBytes(List):
+    OutHandle = io.BytesIO()
     ListToIff(List, OutHandle)
+    return OutHandle.getvalue()
+
+@SfStage('DictToSf')
+def DictToSf(Dict, Dst):
+    SfItemsToSf(DictSf2Items(Dict), Dst)
+
+# Compiles (tag, value) pairs as read by XmlSf2Items: every wavetable,
+# instrument and preset is compiled as it comes and can be dropped, only the
+# INFO values are kept. The whole layout is known before any audio is read,
+# so the file is then written front to back: RIFF header, INFO, sdta (every
+# sample copied exactly once), then pdta.
+# With Old, an SfRiff of a previous build, the sample data of the wavetables
+# that are not in Changed is copied from it, see SfShdrBuilder.
+def SfItemsToSf(Items, Dst, Old = None, Changed = ()):
+    Info = {}
+    Wavetables = SfShdrBuilder(Old, Changed)
+    Instruments = SfZoneBuilder(SfZoneType('instrument'))
+    Presets = SfZoneBuilder(SfZoneType('preset'))
+    for (
+        Tag,
+        Value
+    ) in Items:
+        if Tag == 'wavetable':
+            Wavetables.Add(Value)
+        elif Tag == 'instrument':
+            Instruments.Add(Value)
+        elif Tag == 'preset':
+            Presets.Add(Value)
+        else:
+            Info[Tag] = Value
+    InfoD = ListToBytes(SfInfo(Info))
+    (
+        Layout,
+        Shdr
+    ) = Wavetables.Finish(*Def(SfIfil(Info), (2, 1)))
+    PdtaD = ListToBytes(SfPdta(
+        Instruments.Finish(Wavetables.Count),
+        Presets.Finish(Instruments.HdrC),
+        Shdr
+    ))
+    OutHandle = open(Dst, 'wb')
+    OutHandle.write(struct.pack(
+        '<4sI4s',
+        b'RIFF',
+        4 + len(InfoD) + Layout.ListSize() + len(PdtaD),
+        b'sfbk'
+    ))
+    OutHandle.write(InfoD)
+    SfSdtaWrite(Layout, OutHandle)
+    OutHandle.write(PdtaD)
     OutHandle.close()
+    SfBytesWritten(12 + len(InfoD) + len(PdtaD))
 
 logging.getLogger().setLevel(logging.WARN)
 PysfVersion = 3
@@ -1444,15 +2485,78 @@ SfModTypeDescs = (
     'Convex',
     'Switch'
 )
-XmlHeaderStr = u'<sf:pysf version="' + ustr(PysfVersion) + u'" xmlns:sf="http://terrorpin.net/~ben/docs/alt/music/soundfont/pysf" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://terrorpin.net/~ben/docs/alt/music/soundfont/pysf pysf.xsd">'
-XmlRootStr = XmlHeaderStr + u'</sf:pysf>'
+# root start tag of a manifest, attributes in the order minidom wrote them
+XmlNamespace = u'http://terrorpin.net/~ben/docs/alt/music/soundfont/pysf'
+XmlHeaderStr = u'<sf:pysf xmlns:sf="' + XmlNamespace + u'" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" version="' + ustr(PysfVersion) + u'" xsi:schemaLocation="' + XmlNamespace + u' pysf.xsd">'
+SfBinMagic = b'pysfbin\0'
+SfBinVersion = 1
+SfBinHeader = struct.Struct('<8sI')
+SfBinSize = struct.Struct('<I')
+SfBinKey = struct.Struct('<H')
+SfBinDict = struct.Struct('<cI')
+# (type code, codec, min, max) of the int types, smallest first
+SfBinInts = (
+    (b'b', struct.Struct('<b'), -0x80, 0x7f),
+    (b'h', struct.Struct('<h'), -0x8000, 0x7fff),
+    (b'i', struct.Struct('<i'), -0x80000000, 0x7fffffff),
+    (b'q', struct.Struct('<q'), -0x8000000000000000, 0x7fffffffffffffff)
+)
+SfBinIntCodecs = dict((Code, Codec) for (Code, Codec, Min, Max) in SfBinInts)
+XmlRootName = u'pysf'
+XmlListTags = frozenset(['gen', 'instrument', 'preset', 'wavetable', 'zone'])
+XmlItemContainers = {
+    u'wavetables': u'wavetable',
+    u'instruments': u'instrument',
+    u'presets': u'preset'
+}
 SHMIN = -32768
+# generators written out in seconds from timecents, and generators written
+# out as signed amounts
+SfTimecentOpers = frozenset([33, 34, 35, 36, 38])
+SfSignedOpers = frozenset([37, 39, 40])
+# pdta record codecs
+SfShdrCodec = struct.Struct('<20s5IbB2H')
+SfShdrFmtStr = '<20sIIIIIBbHH'
+SfInstCodec = struct.Struct('<20sH')
+SfPhdrCodec = struct.Struct('<20sH2H3I')
+SfBagCodec = struct.Struct('<2H')
+SfGenCodec = struct.Struct('<2H')
 SHOOBVAL = -32769
+# engine name -> (frames per block, byteswap, channel filter, 24 bit split, 24 bit join)
+SfDataEngines = {
+    'python': (1024, DataSwap, ChannelFilter, DataSplit24, DataJoin24),
+    'numpy': (65536, DataSwapNp, ChannelFilterNp, DataSplit24Np, DataJoin24Np)
+}
+# None picks numpy when it is installed on the first DataCopy
+SfDataEngine = None
+if os.environ.get('PYSF_DATA_ENGINE') != None:
+    DataEngineSet(os.environ.get('PYSF_DATA_ENGINE'))
+# threads writing wavetables in --sf2xml, None for one per CPU
+SfWorkers = None
+if os.environ.get('PYSF_WORKERS') != None:
+    WorkersSet(os.environ.get('PYSF_WORKERS'))
 
 if __name__ == '__main__':
+    if len(sys.argv) == 6 and         \
+        sys.argv[1] == '--update'     \
+    :
+        SfUpdate(sys.argv[2], SfIdList(sys.argv[3]), sys.argv[4], sys.argv[5])
+        sys.exit(0)
+    if len(sys.argv) == 3 and         \
+        sys.argv[1] == '--list'       \
+    :
+        SfWavetablePrint(sys.argv[2])
+        sys.exit(0)
+    if len(sys.argv) == 5 and         \
+        sys.argv[1] == '--extract'    \
+    :
+        SfWavetableExtract(sys.argv[2], sys.argv[3], sys.argv[4])
+        sys.exit(0)
     if len(sys.argv) != 4:             PrintUsage()
     if (sys.argv[1] == '--sf2xml'):    SfToXml(sys.argv[2], sys.argv[3])
     elif (sys.argv[1] == '--xml2sf'):  XmlToSf(sys.argv[2], sys.argv[3])
+    elif (sys.argv[1] == '--sf2bin'):  SfToBin(sys.argv[2], sys.argv[3])
+    elif (sys.argv[1] == '--bin2sf'):  BinToSf(sys.argv[2], sys.argv[3])
     elif (sys.argv[1] == '--aif2xml'): AudToXml(sys.argv[2], sys.argv[3], 'aif')
     elif (sys.argv[1] == '--xml2aif'): XmlToAud(sys.argv[2], sys.argv[3], 'aif')
     elif (sys.argv[1] == '--wav2xml'): AudToXml(sys.argv[2], sys.argv[3], 'wav')
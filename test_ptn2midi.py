@@ -0,0 +1,63 @@
+# Description:
+#  Checks ptn2midi's pattern renderer on a synthetic card written by benchmark.generate_card.
+
+# Usage:
+#  python -m pytest test_ptn2midi.py
+#  or python -m unittest test_ptn2midi
+
+import hashlib
+import shutil
+import struct
+import tempfile
+import unittest
+
+import benchmark
+import ptn2midi
+
+
+# a digest rather than the data, so that a mismatch fails fast instead of diffing whole files
+def read_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class RenderTest(unittest.TestCase):
+    # a card whose pads cover the settings the renderer applies: volume, reverse and gate
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='test_ptn2midi_') + '/'
+        self.card = self.directory + 'card/'
+        self.patterns = benchmark.generate_card(self.card, patterns=2, notes=48, pads=12, frames=2205)
+        with open(self.card + ptn2midi.PADINFO_PATH, 'rb') as f:
+            records = list(struct.iter_unpack(ptn2midi.PAD_FORMAT, f.read()))
+        for index, record in enumerate(records):
+            record = list(record)
+            record[4] = 40 + index % 88  # volume
+            record[7] = index % 3 == 0  # gate
+            record[8] = index % 2 == 0  # reverse
+            records[index] = struct.pack(ptn2midi.PAD_FORMAT, *record)
+        with open(self.card + ptn2midi.PADINFO_PATH, 'wb') as f:
+            f.write(b''.join(records))
+
+    def tearDown(self):
+        ptn2midi.numpy = False  # imported again on next use
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def render(self, output_dir):
+        pads = ptn2midi.get_pad_info(self.card)
+        for pattern in self.patterns:
+            ptn2midi.render_pattern(pads, self.card, pattern, 120, 'WAV', output_dir)
+        return [read_digest(output_dir + "PTN_" + pattern + ".wav") for pattern in self.patterns]
+
+    # the numpy mix and the pure Python one write the same files
+    def test_numpy_matches_python(self):
+        if ptn2midi.load_numpy() is None:
+            self.skipTest("numpy is not installed")
+        mixed = self.render(self.directory + 'numpy/')
+        ptn2midi.numpy = None
+        self.assertEqual(self.render(self.directory + 'python/'), mixed)
+        with open(self.directory + 'numpy/PTN_' + self.patterns[0] + '.wav', 'rb') as f:
+            self.assertTrue(f.read()[44:].strip(b'\0'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+# Description:
+#  Checks that the different ways pysf builds a SoundFont agree byte for byte, on a synthetic card written by
+#  benchmark.generate_card.
+
+# Usage:
+#  python -m pytest test_pysf.py
+#  or python -m unittest test_pysf
+
+import os
+import os.path
+import random
+import shutil
+import tempfile
+import unittest
+
+import benchmark
+import ptn2midi
+import pysf
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class SoundFontTest(unittest.TestCase):
+    # a card, the wavetables of its first pattern and their manifest as ptn2midi writes it
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='test_pysf_') + '/'
+        self.card = self.directory + 'card/'
+        pattern = benchmark.generate_card(self.card, notes=32, pads=6, frames=2205)[0]
+        pads = ptn2midi.get_pad_info(self.card)
+        notes = ptn2midi.get_pattern(self.card, pattern)
+        self.wave_table_list, self.path_list = ptn2midi.create_midi_file(pads, notes, 120, self.card, pattern, 'WAV',
+                                                                         self.directory, self.directory)
+        self.xml = self.directory + 'PTN.xml'
+        ptn2midi.create_template(pattern, self.wave_table_list, self.path_list).XmlWrite(self.xml)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def xml_to_sf(self, xml, name):
+        sf2 = self.directory + name
+        pysf.XmlToSf(xml, sf2)
+        return read_bytes(sf2)
+
+    # manifests written by the old ptn2midi template bind the sf: prefix to "."
+    def test_old_template_namespace(self):
+        old_xml = self.directory + 'old.xml'
+        with open(self.xml) as f:
+            manifest = f.read()
+        self.assertIn('xmlns:sf="%s"' % pysf.XmlNamespace, manifest)
+        with open(old_xml, 'w') as f:
+            f.write(manifest.replace('xmlns:sf="%s"' % pysf.XmlNamespace, 'xmlns:sf="."'))
+        self.assertEqual(self.xml_to_sf(old_xml, 'old.sf2'), self.xml_to_sf(self.xml, 'new.sf2'))
+        self.assertEqual(pysf.XmlFileToDict(old_xml), pysf.XmlFileToDict(self.xml))
+
+    # --sf2bin/--bin2sf and --sf2xml/--xml2sf of the same SoundFont build the same file
+    def test_bin_matches_xml(self):
+        self.xml_to_sf(self.xml, 'PTN.sf2')
+        pysf.SfToXml(self.directory + 'PTN.sf2', self.directory + 'x.xml')
+        pysf.SfToBin(self.directory + 'PTN.sf2', self.directory + 'b.bin')
+        pysf.BinToSf(self.directory + 'b.bin', self.directory + 'b.sf2')
+        self.assertEqual(read_bytes(self.directory + 'b.sf2'), self.xml_to_sf(self.directory + 'x.xml', 'x.sf2'))
+
+    # --update with new audio for one wavetable builds the same file as a full --xml2sf
+    def test_update_matches_full_build(self):
+        old = self.xml_to_sf(self.xml, 'old.sf2')
+        pysf.SfUpdate(self.directory + 'old.sf2', [], self.xml, self.directory + 'same.sf2')
+        self.assertEqual(read_bytes(self.directory + 'same.sf2'), old)
+        benchmark.write_sample(self.path_list[1], 2205, 2, 2, 'WAV', random.Random(2))
+        pysf.SfUpdate(self.directory + 'old.sf2', [2], self.xml, self.directory + 'update.sf2')
+        self.assertEqual(read_bytes(self.directory + 'update.sf2'), self.xml_to_sf(self.xml, 'full.sf2'))
+        self.assertNotEqual(read_bytes(self.directory + 'update.sf2'), old)
+
+    # wavetables that changed places keep their own audio, even where the lengths match
+    def test_update_with_shifted_ids(self):
+        self.xml_to_sf(self.xml, 'old.sf2')
+        sf2 = pysf.XmlFileToDict(self.xml)[u'sf:pysf'][u'sf2']
+        wavetables = sf2[u'wavetables'][u'wavetable']
+        for key in (u'file', u'name'):
+            wavetables[0][key], wavetables[1][key] = wavetables[1][key], wavetables[0][key]
+        shifted_xml = self.directory + 'shifted.xml'
+        with open(shifted_xml, 'w') as f:
+            pysf.DictToXmlFile({u'sf2': sf2}, f)
+        pysf.SfUpdate(self.directory + 'old.sf2', [], shifted_xml, self.directory + 'update.sf2')
+        self.assertEqual(read_bytes(self.directory + 'update.sf2'), self.xml_to_sf(shifted_xml, 'full.sf2'))
+
+    # a number picks the wavetable with that id, even when an earlier wavetable is named like it
+    def test_find_id_before_name(self):
+        sf2 = pysf.XmlFileToDict(self.xml)[u'sf:pysf'][u'sf2']
+        sf2[u'wavetables'][u'wavetable'][0][u'name'] = u'2'
+        pysf.DictToSf(sf2, self.directory + 'named.sf2')
+        riff = pysf.SfRiff(self.directory + 'named.sf2')
+        self.assertEqual(pysf.SfWavetableFind(riff, '2')[0], 2)
+        self.assertEqual(pysf.SfWavetableFind(riff, 2)[0], 2)
+        riff.Close()
+
+
+if __name__ == '__main__':
+    unittest.main()